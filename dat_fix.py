@@ -5,15 +5,119 @@
 import wave 
 import struct
 import numpy as np
-import sys
+import os
+import hashlib
+import csv
+import json
+import argparse
+import contextlib
+import io
+import queue
+import threading
+import time
+import cProfile
+import re
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import fcntl
+except ImportError: # not on Windows, working copies are plain copies there
+    fcntl = None
 
 CHUNK=4096
+# timings of the whole script for a 2 channel take, see --metrics for timings of each stage
 #  1024 0m56.249s
 #  2048 0m54.811s
 #  4096 0m54.317s
 #  8192 0m55.491s
 # 16384 0m56.624s
 
+# dropout region record: channel, first frame of the run of equal samples,
+# number of frames in the run and the held sample value
+DROPOUT_DTYPE = np.dtype( [ ("channel", np.uint8), ("start", np.int64),
+                            ("length", np.int64), ("value", np.int16) ] )
+
+# fill plan record: channel, first frame and number of frames to replace, counted from the
+# start of the reference program, the take to copy them from and how many frames of the
+# dropout are dropouts in that take too, or not in it at all
+FILL_DTYPE = np.dtype( [ ("channel", np.uint8), ("start", np.int64), ("length", np.int64),
+                         ("donor", np.uint8), ("overlap", np.int64) ] )
+
+# patch (edit list) record: channel, first frame and number of frames of the output to copy from
+# another take, the take (an index into the patch's list of takes) and the offset of its frames,
+# so output frame n is frame n + offset of the take
+PATCH_DTYPE = np.dtype( [ ("channel", np.uint8), ("start", np.int64), ("length", np.int64),
+                          ("take", np.uint8), ("offset", np.int64) ] )
+PATCH_VERSION=1
+
+# quality timeline record, see quality_timeline(): first program frame and number of frames of the
+# window, duplicated samples in it, the longest run of equal samples reaching into it (0 if none
+# is longer than the run table's run_min) and the samples that differ from the other takes
+TIMELINE_DTYPE = np.dtype( [ ("start", np.int64), ("length", np.int64), ("dups", np.int64),
+                             ("longest", np.int64), ("differ", np.int64) ] )
+# default window of the timeline, in seconds
+TIMELINE_SECONDS=1.0
+
+# ioctl to clone a file on Linux filesystems with reflinks (btrfs, XFS), see _clone_file()
+FICLONE=0x40049409
+
+# least time between progress updates, in seconds
+PROGRESS_INTERVAL=0.5
+
+# chunks read ahead of, and written behind, the multi-take loops
+PREFETCH_DEPTH=16
+
+# shortest segment of a file scanned by each worker process, in frames
+SEGMENT_MIN=CHUNK*256
+
+# largest block read at once when looking for the end of the leader, in frames
+LEADER_MAX_BLOCK=CHUNK*256
+
+# duplicate run histograms count runs shorter than this in an array, longer runs in a dict
+HIST_DENSE=65536
+
+# the run table from analyze() keeps runs of more than RUN_MIN equal samples (or thresh, if lower)
+# so a cached analysis can be reused for any thresh of RUN_MIN or more
+RUN_MIN=10
+
+# sidecar cache of analyze() results, kept next to each wave file
+SIDECAR_EXT=".dat_fix.npz"
+SIDECAR_VERSION=3
+# bytes at each end of the data hashed to check the sidecar still matches the file
+SIDECAR_HASH_BYTES=4096
+
+# block digests of a take, see block_digests(): frames per block, counted from the end of the leader
+# and hashed during the analysis pass
+DIGEST_FRAMES=4096
+# base of the rolling hash used to find a block at any shift, odd so it has an inverse modulo 2**64
+ROLL_BASE=0x9E3779B97F4A7C15
+
+# inter-take differences, see scan_differences(): a take departs from the others where at least
+# DIFF_MIN of DIFF_WINDOW successive samples differ from the consensus of the takes
+DIFF_WINDOW=32
+DIFF_MIN=8
+
+# batch mode, see find_sessions(): a take is named <tape><separator><number>.wav, the number
+# ordering the takes of a tape, and the files written for each session in the output directory
+TAKE_PATTERN=re.compile( r"^(.*?)[ _.-]*(?:take)?[ _-]*(\d+)$", re.IGNORECASE )
+BATCH_OUTPUT=".fixed.wav"
+BATCH_REPORT=".report.txt"
+BATCH_JOURNAL=".journal.jsonl"
+
+# take alignment: length of the excerpt compared, largest shift searched (in seconds)
+# and the decimation factor of the coarse FFT search
+ALIGN_SECONDS=10
+ALIGN_SEARCH_SECONDS=1
+ALIGN_DECIMATE=16
+
+# drift mapping: window compared at a time (seconds), fraction of equal samples for a
+# window to be in sync, frames used to search for a new offset and largest slip (seconds)
+DRIFT_WINDOW_SECONDS=1
+DRIFT_MATCH=0.5
+DRIFT_PROBE=8192
+DRIFT_MAX_SLIP_SECONDS=0.1
+
 class DAT_Fix:
     """
     " scan a wav file from a DAT transfer for "drop-outs"
@@ -30,6 +134,18 @@ class DAT_Fix:
         first_right=None
         last_right=None
         count_right=0
+
+        # reuse analyze() results from the sidecar next to each file
+        self.use_cache = True
+
+        # worker processes used to scan a file
+        self.jobs = 1
+
+        # progress reports, see _progress(), and per stage timings, see print_metrics()
+        self.quiet = False
+        self.progress_callback = None
+        self.progress_time = 0.0
+        self.metrics = {}
     # END DAT_Fix.init()
         
     def sample_to_time( self, sample ):
@@ -56,53 +172,136 @@ class DAT_Fix:
         """
         " internal function used by DAT_Fix.scan_file()
         """
-        self.left_state  = { "first":None, "last":None, "count":0, "prev":0, "channel":"L" }
-        self.right_state = { "first":None, "last":None, "count":0, "prev":0, "channel":"R" }
         self.error = 0
     # END DAT_Fix._init_file()
 
-    def _analyze_frame( self, sample, state, thresh=100 ):
+    def _progress( self, stage, done, total, text ):
         """
-        " internal function used by DAT_Fix.scan_file()
+        " report progress of a stage, at most every PROGRESS_INTERVAL seconds
+        " and when it completes, rather than for every chunk
+        "
+        " inputs:
+        "   stage       - name of the stage, see _stage_done()
+        "   done, total - units of work done so far, and in all
+        "   text        - function returning the progress line, only called when it is printed
+        "
+        " the line is overwritten in place unless self.quiet is set, and
+        " self.progress_callback( stage, done, total ) is called if set
         """
-        #thresh= 100
-        #print("A: "+fname+" {0:s} {1:s}".format( self.sample_to_time( self.frame_num), state["channel"] ))
-        for i in range( len(sample) ):
-            if sample[i] == state["prev"]:
-                if 0 == state["count"]:
-                    state["first"] ="{0:s} {1:5d}".format( self.sample_to_time( i+ self.frame_num), sample[i] )
-                    state["count"] = 1
-                else:
-                    state["count"] += 1
-                    if state["count"] > thresh:
-                        state["last"] = "{0:s} {1:5d}".format( self.sample_to_time( i + self.frame_num ), sample[i])
-            else: # not equal
-                if state["first"] is not None and state["last"] is not None:
-                    if self.error == 0:
-                        print("") # force newline
-                        self.error = 1
-                    print ( state["channel"] + " Start " + state["first"] + " End " + state["last"] +
-                            " Dur " + self.sample_to_time( state["count"] ))
-                state["first"]=None
-                state["last"]=None
-                state["count"] = 0
-                state["prev"] = sample[i]
-    # END DAT_Fix._analyze_frame()
-        
-    def _analyze_frame_last( self, state ):
+        now = time.monotonic()
+        if done < total and now - self.progress_time < PROGRESS_INTERVAL:
+            return
+        self.progress_time = now
+
+        if self.progress_callback is not None:
+            self.progress_callback( stage, done, total )
+        if not self.quiet:
+            print( text(), end='\r', flush=True )
+    # END DAT_Fix._progress()
+
+    def _stage_start( self ):
+        """
+        " internal function, start timing a stage, see _stage_done()
+        """
+        return time.perf_counter()
+    # END DAT_Fix._stage_start()
+
+    def _stage_done( self, stage, t0, frames, nbytes ):
+        """
+        " internal function, add a run of a stage to self.metrics
+        "
+        " inputs:
+        "   stage  - info, leader, trailer, score, scan, align, drift, median or fill
+        "   t0     - from _stage_start()
+        "   frames - frames processed
+        "   nbytes - bytes of sample data read
+        """
+        metrics = self.metrics.setdefault( stage, { "calls":0, "seconds":0.0, "frames":0, "bytes":0 } )
+        metrics[ "calls" ]   += 1
+        metrics[ "seconds" ] += time.perf_counter() - t0
+        metrics[ "frames" ]  += int( frames )
+        metrics[ "bytes" ]   += int( nbytes )
+    # END DAT_Fix._stage_done()
+
+    def print_metrics( self ):
+        """
+        " print the time, frames per second and read rate of each stage run so far
+        """
+        print( "stage     calls   seconds     frames/s      MB/s" )
+        for (stage, m) in self.metrics.items():
+            seconds = max( m[ "seconds" ], 1e-9 )
+            print( "{0:8s} {1:6d} {2:9.3f} {3:12.0f} {4:9.1f}".format(
+                stage, m[ "calls" ], m[ "seconds" ], m[ "frames" ] / seconds, m[ "bytes" ] / seconds / 1e6 ))
+    # END DAT_Fix.print_metrics()
+
+    def _find_runs( self, sample, state, frame_num ):
+        """
+        " internal run-length engine shared by scan_file(), dropout_score() and do_scan_and_fill_2()
+        "
+        " finds every run of equal samples in one channel of a chunk with array
+        " operations, rather than walking the chunk one sample at a time.
+        " The run still open at the end of the chunk is carried in state
+        " to the next chunk, so runs crossing CHUNK boundaries are found whole.
+        "
+        " inputs:
+        "   sample    - numpy array with one channel of the chunk
+        "   state{}   - run state carried from chunk to chunk
+        "   state[ "prev" ]   - value of the open run
+        "   state[ "start" ]  - frame number of the first sample of the open run
+        "   state[ "length" ] - number of samples in the open run so far
+        "   state[ "dups" ]   - running count of samples equal to the sample before them
+        "   frame_num - frame number of sample[0]
+        "
+        " outputs:
+        "   (starts, lengths, values) - numpy arrays describing the runs completed in this chunk,
+        "                               in order. A run is complete when a different sample follows it.
+        "   state is updated in place
+        """
+        size = len( sample )
+        if size == 0:
+            return ( np.empty( 0, dtype=np.int64 ), np.empty( 0, dtype=np.int64 ), sample[:0] )
+
+        # change points - index of each sample that differs from the one before it
+        change = np.flatnonzero( np.diff( sample ) ) + 1
+        if sample[0] != state["prev"]:
+            change = np.concatenate( ( [0], change ) )
+        state["dups"] += size - len( change )
+
+        if len( change ) == 0: # the open run continues through the whole chunk
+            state["length"] += size
+            return ( np.empty( 0, dtype=np.int64 ), np.empty( 0, dtype=np.int64 ), sample[:0] )
+
+        # runs lie between successive change points, the first one completes the open run
+        starts  = np.concatenate( ( [state["start"]], change[:-1] + frame_num ) )
+        lengths = np.diff( change, prepend=0 )
+        lengths[0] += state["length"]
+        values  = np.concatenate( ( [state["prev"]], sample[change[:-1]] ) ).astype( sample.dtype )
+
+        # carry the new open run into the next chunk
+        state["prev"]   = sample[-1]
+        state["start"]  = frame_num + change[-1]
+        state["length"] = size - change[-1]
+
+        if lengths[0] == 0: # nothing was open yet
+            return ( starts[1:], lengths[1:], values[1:] )
+        return ( starts, lengths, values )
+    # END DAT_Fix._find_runs()
+
+    def _print_dropout( self, channel, start, count, value ):
         """
         " internal function used by DAT_Fix.scan_file()
+        "
+        " print one dropout, count duplicate samples following the sample at start
         """
-        if state["first"] is not None and state["last"] is not None:
-            if self.error == 0:
-                print("") # force newline
-                self.error = 1
-            print ( state["channel"] + " Start " + state["first"] + " End " + state["last"] +
-                    " Dur " + self.sample_to_time( state["count"] ))
-    # END DAT_Fix._analyze_frame_last()
-        
-    
-    def scan_file( self, fname, thresh=100 ):
+        if self.error == 0:
+            print("") # force newline
+            self.error = 1
+        print ( channel + " Start " + "{0:s} {1:5d}".format( self.sample_to_time( start + 1 ), int( value ) ) +
+                " End " + "{0:s} {1:5d}".format( self.sample_to_time( start + count ), int( value ) ) +
+                " Dur " + self.sample_to_time( count ))
+    # END DAT_Fix._print_dropout()
+
+    def scan_file( self, fname, thresh=100, quiet=False ):
         """
         " scan the specified wave file for sequences of duplicated
         " samples of length greater than thresh. These sequences
@@ -115,68 +314,82 @@ class DAT_Fix:
         "           default: 100, although 50, 25, 20 also seem to perform reasonably well
         "           low thresh values (<10) risk false positives generated by real
         "           content of the wave file (possibly low frequency or low volume sections)
+        "   quiet:  <optional> don't print each dropout
         "
         " output:
+        "   DROPOUT_DTYPE array of the dropouts, in the order they are printed. start is the first
+        "   duplicated sample and length the number of duplicates, so the held value is the sample
+        "   at start - 1. See export_events() to save them
         "   diagnostics printed to stdout
+        "
+        " uses the same single pass as analyze(), so a file with a current sidecar isn't read again
         """
-        # TODO - return count of dropout/duplicate frames
-        # as a score for evaluting relative quality of different files 
         if fname is None:
             raise ValueError
 
-        wav = wave.open (fname, "r")
+        file = { "name":fname }
+        self.get_file_info( file )
 
-        (self.nchannels, self.sampwidth, self.framerate,
-         self.nframes, self.comptype, self.compname)     = wav.getparams ()
+        self.nchannels = file[ "nchannels" ]
+        self.sampwidth = file[ "sampwidth" ]
+        self.framerate = file[ "framerate" ]
+        self.nframes   = file[ "nframes" ]
+        self.comptype  = file[ "comptype" ]
+        self.compname  = file[ "compname" ]
 
         #print("O: "+fname+" {0:d} channels {1:d} frames".format(self.nchannels, self.nframes) )
         
         print("A: "+fname, end='', flush=True)
         self._init_file()
 
-        # ceil( nframes / CHUNK)
-        # thanks to https://stackoverflow.com/questions/14822184/is-there-a-ceiling-equivalent-of-operator-in-python
-        # ceil ( a /b ) == -( -a // b)
-        num_chunks = -( -self.nframes // CHUNK)
-        
-        self.frame_num = 0
-        
-        for chunk_num in range( num_chunks ):
-
-            # handle possibly odd sized last chunk
-            if self.frame_num + CHUNK > self.nframes:
-                chunk_size = self.nframes - chunk_num*CHUNK
-            else:
-                chunk_size = CHUNK
-
-            # read the next chunk
-            frame = wav.readframes ( chunk_size )
-            out = struct.unpack_from ( "%dh" % self.nchannels * chunk_size, frame )
-
-            # Convert 2 channels to numpy arrays and analyze for drop-outs
-            if self.nchannels == 2:
-                left_samples  = np.array (list ( out[0::2] ))
-                right_samples = np.array (list ( out[1::2] ))
-                self._analyze_frame( left_samples,  self.left_state , thresh )
-                self._analyze_frame( right_samples, self.right_state, thresh )
-            else:
-                left_samples  = np.array (list ( out[0::2] ))
-                self._analyze_frame( left_samples, self.left_state )
-            self.frame_num += chunk_size
+        # the analysis has every run in the file, or is loaded from the sidecar
+        self._analyze( file, thresh )
+        events = self.dropout_events( file, thresh )
 
-        # catch "hanging" dropout at end of file
-        self._analyze_frame_last( self.left_state )
-        self._analyze_frame_last( self.right_state )
+        if not quiet:
+            for event in events:
+                self._print_dropout( "LR"[ event[ "channel" ] ], event[ "start" ] - 1, event[ "length" ], event[ "value" ] )
 
-        # close file
-        wav.close()
-
-        if self.error == 0:
+        if len( events ) == 0:
             print(" OK")
         else:
+            if self.error == 0:
+                print("")
             print( "Done" )
+        return events
     # END DAT_Fix.scan_file()
 
+    def dropout_events( self, file, thresh=100 ):
+        """
+        " the dropouts scan_file() reports, from the run table of an analyzed take
+        "
+        " a dropout is more than thresh samples (and at least 2) duplicating the one before
+        " them, anywhere in the file. file[ "dropouts" ] differs: its records are whole runs,
+        " held sample included, of more than thresh samples, trimmed to the program
+        "
+        " inputs:
+        "   file{}  - file info dictionary, after analyze()
+        "   thresh  - optional - specify threshold dropout size
+        "
+        " outputs:
+        "   DROPOUT_DTYPE array. start is the first duplicated sample and length the number of
+        "   duplicates, so the held value is the sample at start - 1. In the order a scan finds
+        "   them, by the chunk each one ends in, left before right, and runs still open at the
+        "   end of the file last
+        """
+        if file[ "run_min" ] > max( thresh, 1 ): # the table doesn't go down to thresh
+            self._analyze( file, thresh )
+
+        runs = file[ "runs" ][ file[ "runs" ][ "length" ] - 1 > max( thresh, 1 ) ]
+        ends = runs[ "start" ] + runs[ "length" ]
+        found = np.where( ends < file[ "nframes" ], ends // CHUNK, file[ "nframes" ] // CHUNK + 1 )
+
+        events = runs[ np.lexsort( ( ends, runs[ "channel" ], found ) ) ]
+        events[ "start" ]  += 1
+        events[ "length" ] -= 1
+        return events
+    # END DAT_Fix.dropout_events()
+
     def get_file_info( self, file ):
         """
         " Get information from wave file header
@@ -191,23 +404,168 @@ class DAT_Fix:
         "   file[ "sampwidth" ] - number of bytes per channel 
         "   file[ "framerate" ] - number of frames per second 
         "   file[ "nframes" ]   - total number of frames in the file 
+        "   file[ "data_offset" ] - byte offset of the sample data in the file
         """
+        t0 = self._stage_start()
         #print( "I: " + file["name"] )
-        wav = wave.open ( file["name"], "r")
-        #with wave.open ( file["name"], "r") as wav:
-
-        (nchannels, sampwidth, framerate,
-         nframes, comptype, compname)     = wav.getparams ()
-
-        file["nchannels"] = nchannels
-        file["sampwidth"] = sampwidth
-        file["framerate"] = framerate
-        file["nframes"]   = nframes
-        file["comptype"]  = comptype
-        file["compname"]  = compname
-        
-        wav.close()
+        header = self._read_header( file["name"] )
+
+        file["nchannels"] = header[ "nchannels" ]
+        file["sampwidth"] = header[ "sampwidth" ]
+        file["framerate"] = header[ "framerate" ]
+        file["nframes"]   = header[ "nframes" ]
+        file["comptype"]  = header[ "comptype" ]
+        file["compname"]  = header[ "compname" ]
+        file["data_offset"] = header[ "data_offset" ]
+        self._stage_done( "info", t0, 0, 0 )
     # END DAT_Fix.get_file_info()
+
+    def _read_header( self, filename ):
+        """
+        " internal function used by DAT_Fix.get_file_info()
+        "
+        " walk the RIFF chunks of a wave file once, reading the "fmt " chunk
+        " and locating the "data" chunk, without reading any of the audio
+        "
+        " outputs:
+        "   dictionary with the same parameters as get_file_info(), and
+        "   header[ "data_offset" ] - byte offset of the first frame in the file
+        "
+        " the frame count is limited to what is actually in the file, since
+        " captures that were never closed properly carry a bogus data length
+        """
+        with open( filename, "rb" ) as f:
+            riff = f.read( 12 )
+            if len( riff ) < 12 or riff[0:4] != b"RIFF" or riff[8:12] != b"WAVE":
+                print( filename + " is not a RIFF/WAVE file" )
+                raise ValueError
+
+            header = {}
+            while True:
+                chunk = f.read( 8 )
+                if len( chunk ) < 8:
+                    print( filename + " has no data chunk" )
+                    raise ValueError
+                (chunk_id, chunk_len) = struct.unpack( "<4sI", chunk )
+
+                if chunk_id == b"fmt ":
+                    fmt = f.read( chunk_len )
+                    (format_tag, nchannels, framerate,
+                     byterate, blockalign, bits) = struct.unpack_from( "<HHIIHH", fmt )
+                    if format_tag == 0xFFFE and chunk_len >= 26: # WAVE_FORMAT_EXTENSIBLE, look at the sub format
+                        format_tag = struct.unpack_from( "<H", fmt, 24 )[0]
+                    if format_tag != 1:
+                        print( filename + " is not PCM audio" )
+                        raise ValueError
+                    header[ "nchannels" ] = nchannels
+                    header[ "sampwidth" ] = ( bits + 7 ) // 8
+                    header[ "framerate" ] = framerate
+                    header[ "comptype" ]  = "NONE"
+                    header[ "compname" ]  = "not compressed"
+                    f.seek( chunk_len & 1, 1 )
+
+                elif chunk_id == b"data":
+                    if "nchannels" not in header:
+                        print( filename + " has no fmt chunk before the data" )
+                        raise ValueError
+                    header[ "data_offset" ] = f.tell()
+                    data_len = min( chunk_len, os.fstat( f.fileno() ).st_size - header[ "data_offset" ] )
+                    header[ "nframes" ] = data_len // ( header[ "nchannels" ] * header[ "sampwidth" ] )
+                    return header
+
+                else: # skip chunks we don't care about, chunks are padded to an even length
+                    f.seek( chunk_len + ( chunk_len & 1 ), 1 )
+    # END DAT_Fix._read_header()
+
+    def _map_samples( self, file, mode="r" ):
+        """
+        " map the data chunk of a wave file into memory, without reading or copying it
+        "
+        " inputs:
+        "   file{} - file info dictionary provided by get_file_info()
+        "   mode   - numpy.memmap mode, "r" for read only
+        "
+        " outputs:
+        "   int16 numpy array of shape (nframes, nchannels) backed by the file,
+        "   channels are samples[:, 0], samples[:, 1] and frame ranges are
+        "   slices, all of which are views into the file rather than copies
+        """
+        if file[ "sampwidth" ] != 2:
+            print( "Can't handle anything other than 16 bit samples yet" )
+            raise ValueError
+
+        shape = ( file[ "nframes" ], file[ "nchannels" ] )
+        if file[ "nframes" ] == 0: # can't map an empty region
+            return np.zeros( shape, dtype="<i2" )
+
+        return np.memmap( file[ "name" ], dtype="<i2", mode=mode,
+                          offset=file[ "data_offset" ], shape=shape )
+    # END DAT_Fix._map_samples()
+
+    def iter_blocks( self, file, start=None, stop=None, block_frames=None ):
+        """
+        " generator of the frames of a take, a block at a time
+        "
+        " inputs:
+        "   file{}       - file info dictionary provided by get_file_info()
+        "   start, stop  - optional - frame range [start, stop) in the file, by default the working
+        "                  range between the leader and the trailer, as far as they are known
+        "   block_frames - optional - frames per block, CHUNK by default, the last block may be shorter
+        "
+        " outputs:
+        "   yields (frame, block) - frame number of block[0] in the file, and an int16 numpy
+        "          array (frames, nchannels) that is a view into the mapped file
+        """
+        if block_frames is None:
+            block_frames = CHUNK
+        if start is None:
+            start = file.get( "leader_length", 0 )
+        if stop is None:
+            stop = file[ "nframes" ] - file.get( "trailer_length", 0 )
+
+        samples = self._map_samples( file )
+        for frame in range( start, stop, block_frames ):
+            yield ( frame, samples[ frame : min( stop, frame + block_frames ) ] )
+    # END DAT_Fix.iter_blocks()
+
+    def iter_takes( self, file_list, start=0, stop=None, block_frames=None, prefetch=True, skip=None ):
+        """
+        " generator of the program from several aligned takes in lockstep, a block at a time
+        "
+        " frames are counted from the start of the program, each take is read from its
+        " leader_length + offset, following its offset_map if map_drift() made one, and
+        " frames outside a take are zero
+        "
+        " inputs:
+        "   file_list    - list of file info dicts, after analyze() and align_takes()
+        "   start, stop  - optional - program frame range [start, stop), by default up to
+        "                  the end of the shortest take
+        "   block_frames - optional - frames per block, CHUNK by default, the last block may be shorter
+        "   prefetch     - optional - read each take ahead on a background thread, see _read_ahead()
+        "   skip         - optional - function of the program frame range (first, last) of a block,
+        "                  True where only the first take is needed, see _skip_same()
+        "
+        " outputs:
+        "   yields (frame, blocks) - program frame number of the blocks, and a list with an
+        "          int16 numpy array (frames, nchannels) from each take, or None for the
+        "          takes after the first where skip() is True
+        """
+        if block_frames is None:
+            block_frames = CHUNK
+        if stop is None:
+            stop = min( self._program_length( file ) for file in file_list )
+
+        if prefetch:
+            yield from self._read_ahead( file_list, start, stop, block_frames, skip )
+            return
+
+        samples = [ self._map_samples( file ) for file in file_list ]
+        for frame in range( start, stop, block_frames ):
+            last = min( stop, frame + block_frames )
+            skipped = skip is not None and skip( frame, last )
+            yield ( frame, [ None if i > 0 and skipped else self._read_mapped( file, samples[i], frame, last )
+                             for (i, file) in enumerate( file_list ) ] )
+    # END DAT_Fix.iter_takes()
     
     def print_file_info( self, file ):
         print( "P: " + file["name"] )
@@ -236,6 +594,7 @@ class DAT_Fix:
         "
         " assumes sampwidth == 2 ???
         """
+        t0 = self._stage_start()
         if file[ "name" ] is None:
             raise ValueError
 
@@ -249,52 +608,94 @@ class DAT_Fix:
             print( "Can't handle anything other than stereo yet")
             raise ValueError
 
-        wav = wave.open ( filename, "r")
+        samples = self._map_samples( file )
 
-        # ceil( nframes / CHUNK)
-        # thanks to https://stackoverflow.com/questions/14822184/is-there-a-ceiling-equivalent-of-operator-in-python
-        # ceil ( a /b ) == -( -a // b)
-        num_chunks = -( -file[ "nframes" ] // CHUNK )
-        
+        # gallop through the leader: each block is twice the size of the one before,
+        # up to LEADER_MAX_BLOCK, so a short leader costs one small read and a long
+        # one a handful of large ones. Each block is checked with a single array operation
         lead_frames = 0
-        done = 0
-        
-        for chunk_num in range( num_chunks ):
+        block = CHUNK
 
-            # handle possibly odd sized last chunk
-            if lead_frames + CHUNK > nframes:
-                chunk_size = nframes - chunk_num*CHUNK
-            else:
-                chunk_size = CHUNK
+        while lead_frames < nframes:
+            chunk = samples[ lead_frames : lead_frames + block ]
 
-            # read the next chunk
-            chunk = wav.readframes ( chunk_size )
-            out = struct.unpack_from ( "%dh" % nchannels * chunk_size, chunk )
+            # first nonzero sample in the block, as a frame number
+            nonzero = np.flatnonzero( chunk.reshape( -1 ) )
+            if len( nonzero ):
+                lead_frames += nonzero[0] // nchannels
+                break
 
-            # Convert 2 channels to numpy arrays and analyze for drop-outs
-            left_samples  = np.array (list ( out[0::2] ))
-            right_samples = np.array (list ( out[1::2] ))
+            lead_frames += len( chunk )
+            block = min( 2 * block, LEADER_MAX_BLOCK )
+            self._progress( "leader", lead_frames, nframes, lambda: "{0:s}  leader: {1:d}".format(filename, lead_frames) )
 
-            for i in range( len( left_samples ) ):
-                if left_samples[i] != 0 or right_samples[i] != 0:
-                    done = 1
-                    break
-                else:
-                    lead_frames += 1
-                
-            print( "{0:s}  leader: {1:d}".format(filename, lead_frames), end='\r', flush=True)
-            if done :
-                break
+        lead_frames = int( lead_frames )
 
         print( "\n{0:s}  total frames:{1:d} leader: {2:d} net frames:{3:d}".format(
             filename, nframes, lead_frames, nframes - lead_frames ), end='\r', flush=True)
-        # close file
-        wav.close()
         print()
         file[ "leader_length" ] = lead_frames
                    
+        self._stage_done( "leader", t0, lead_frames, lead_frames * nchannels * file[ "sampwidth" ] )
     # END DAT_Fix.get_leader_length()
 
+    def get_trailer_length( self, file ):
+        """
+        " Scan backwards from the end of a file for the sequence of zero
+        " samples after the program, so that it can be eliminated
+        "
+        " blocks are read from the end towards the start, doubling in size
+        " like get_leader_length(), and the scan stops at the last frame with
+        " a nonzero sample, so only the trailer is read
+        "
+        " inputs:
+        "   file{} - dictionary with info on the wav file from the dat transfer
+        "   file[ "name" ] - the name of the file
+        "   file[ "nchannels" ] - number of audio channels per frame in the file
+        "   file[ "nframes" ]   - total number of frames in the file 
+        "
+        " outputs:
+        "   file[ "trailer_length" ] - count of final zero frames in the file
+        """
+        t0 = self._stage_start()
+        if file[ "name" ] is None:
+            raise ValueError
+
+        # local copies of file parameters
+        filename  = file[ "name" ]
+        nchannels = file[ "nchannels" ]
+        nframes   = file[ "nframes" ]
+
+        samples = self._map_samples( file )
+
+        trail_frames = 0
+        block = CHUNK
+
+        while trail_frames < nframes:
+            end   = nframes - trail_frames
+            chunk = samples[ max( 0, end - block ) : end ]
+
+            # last nonzero sample in the block, as a count of frames after it
+            nonzero = np.flatnonzero( chunk.reshape( -1 ) )
+            if len( nonzero ):
+                trail_frames += len( chunk ) - 1 - nonzero[-1] // nchannels
+                break
+
+            trail_frames += len( chunk )
+            block = min( 2 * block, LEADER_MAX_BLOCK )
+            self._progress( "trailer", trail_frames, nframes, lambda: "{0:s}  trailer: {1:d}".format(filename, trail_frames) )
+
+        # a file of nothing but zeros is all leader
+        if trail_frames >= nframes:
+            trail_frames = 0
+
+        trail_frames = int( trail_frames )
+
+        print( "\n{0:s}  total frames:{1:d} trailer: {2:d}".format( filename, nframes, trail_frames ))
+        file[ "trailer_length" ] = trail_frames
+        self._stage_done( "trailer", t0, trail_frames, trail_frames * nchannels * file[ "sampwidth" ] )
+    # END DAT_Fix.get_trailer_length()
+
     
     def dropout_score_mem( self, file ):
         """
@@ -314,61 +715,46 @@ class DAT_Fix:
         "
         " inputs:
         "   file - a file info dictionary as generated by by get_file_info() function and get_leader_length()
-        "          it is assumed that the entire file fits in memory
-        "          TODO - what is the performance hit due to scanning by chunks instead of using memory buffer
+        "          the whole file is mapped into memory, the operating system pages it in as needed
+        "          the trailer is found with get_trailer_length() if it hasn't been already
         "
         " outputs:
         "   dropout_score - tuple (l, r) count of number of duplicate adjacent samples 
         """
+        t0 = self._stage_start()
+        if "trailer_length" not in file:
+            self.get_trailer_length( file )
+
         # local copies of file parameters
-        filename    = file[ "name" ]
-        nframes     = file[ "nframes" ]
-        lead_frames = file[ "leader_length" ]
+        filename     = file[ "name" ]
+        nframes      = file[ "nframes" ]
+        lead_frames  = file[ "leader_length" ]
+        trail_frames = file[ "trailer_length" ]
 
         #sampwidth = file_list[0][ "sampwidth" ]
         #framerate = file_list[0][ "framerate" ]
 
-        wav = wave.open ( filename, "r")
-
-
-        # ceil( nframes / CHUNK)
-        # thanks to https://stackoverflow.com/questions/14822184/is-there-a-ceiling-equivalent-of-operator-in-python
-        # ceil ( a /b ) == -( -a // b)
-        nframes = (nframes - lead_frames)
-        num_chunks = -( -nframes // CHUNK )
-        
-        nchannels = 2
-
-        
-        # fast forward through lead_frames
-        wav.readframes ( lead_frames )
-
-        # read all the remaining data
-        # note: currently no mechanism to trim trailer
-        data = wav.readframes( nframes )
+        samples = self._map_samples( file )
 
-        out = struct.unpack_from ( "%dh" % nchannels * nframes, data )
+        nframes = (nframes - lead_frames - trail_frames)
 
-        # Convert 2 channels to numpy arrays and analyze for drop-outs
-        left  = np.array (list ( out[0::2] ))
-        right = np.array (list ( out[1::2] ))
+        # skip the lead_frames and the trail_frames, and take the data between them
+        left  = samples[ lead_frames : lead_frames + nframes, 0 ]
+        right = samples[ lead_frames : lead_frames + nframes, 1 ]
 
         # shift one instance of the array by 1 sample, and subtract
         # to find adjacent duplicate samples
         left_delta  = left [1:] - left [:-1]
         right_delta = right[1:] - right[:-1]
 
-        # adapted from https://stackoverflow.com/questions/2900084/counting-positive-integer-elements-in-a-list-with-python-list-comprehensions
-        # makes a list of the zero element, then length of the list is count of the zero elements
-        left_score  = len( [x for x in left_data  if x == 0] )
-        right_score = len( [x for x in right_data if x == 0] )
+        # count of the zero elements
+        left_score  = int( np.count_nonzero( left_delta  == 0 ) )
+        right_score = int( np.count_nonzero( right_delta == 0 ) )
 
         print( "dropout score: {0:s} frames:{1:d} L:{2:d} R:{3:d} total:{4:d}".format(
-            filename, nframes, left_score, right_score))
-        
-        # close file
-        wav.close()
+            filename, nframes, left_score, right_score, left_score + right_score ))
 
+        self._stage_done( "score", t0, nframes, nframes * file[ "nchannels" ] * file[ "sampwidth" ] )
         return (left_score, right_score)
     # END DAT_Fix.dropout_score_mem()
     
@@ -394,428 +780,2634 @@ class DAT_Fix:
         "
         " inputs:
         "   file - a file info dictionary as generated by by get_file_info() function and get_leader_length()
+        "          the trailer is found with get_trailer_length() if it hasn't been already
         "
         " outputs:
         "   dropout_score - tuple (l, r) count of number of duplicate adjacent samples 
         """
+        t0 = self._stage_start()
+        if "trailer_length" not in file:
+            self.get_trailer_length( file )
+
         # local copies of file parameters
-        filename    = file[ "name" ]
-        nframes     = file[ "nframes" ]
-        lead_frames = file[ "leader_length" ]
+        filename     = file[ "name" ]
+        nframes      = file[ "nframes" ]
+        lead_frames  = file[ "leader_length" ]
+        trail_frames = file[ "trailer_length" ]
 
-        #sampwidth = file_list[0][ "sampwidth" ]
-        framerate = file_list[0][ "framerate" ]
+        #sampwidth = file[ "sampwidth" ]
+        framerate = file[ "framerate" ]
         self.framerate = framerate
         
-        wav = wave.open ( filename, "r")
-
-
-        # ceil( nframes / CHUNK)
-        # thanks to https://stackoverflow.com/questions/14822184/is-there-a-ceiling-equivalent-of-operator-in-python
-        # ceil ( a /b ) == -( -a // b)
-        nframes = (nframes - lead_frames)
-        num_chunks = -( -nframes // CHUNK )
-        
-        nchannels = 2
-
+        nframes = (nframes - lead_frames - trail_frames)
         
-        # fast forward through lead_frames
-        wav.readframes ( lead_frames )
-
         # pre-scan initialization
-        frame_num = 0
-        prev_l = 0
-        prev_r = 0
+        left_state  = { "prev":0, "start":0, "length":0, "dups":0 }
+        right_state = { "prev":0, "start":0, "length":0, "dups":0 }
 
         left_count = 0
         right_count = 0
 
-        for chunk_num in range( num_chunks ):
+        # the chunks after the lead_frames, and their channels, are views into the mapped file
+        for (chunk_num, (frame, chunk)) in enumerate( self.iter_blocks( file ) ):
+            left  = chunk[:, 0]
+            right = chunk[:, 1]
 
-            # handle possibly odd sized last chunk
-            if frame_num + CHUNK > nframes:
-                chunk_size = nframes - chunk_num*CHUNK
-            else:
-                chunk_size = CHUNK
-
-            # read the next chunk
-            chunk = wav.readframes ( chunk_size )
-            out = struct.unpack_from ( "%dh" % nchannels * chunk_size, chunk )
-
-            # Convert 2 channels to numpy arrays and analyze for drop-outs
-            left  = np.array (list ( out[0::2] ))
-            right = np.array (list ( out[1::2] ))
-
-            #chunk_corrected = np.array[ zip( left_m, right_m ) ]
-            for l, r  in zip (left, right ):
-                if l == prev_l:
-                    left_count += 1
-                if r == prev_r:
-                    right_count += 1
-                    
-            prev_l = l
-            prev_r = r
-            
-            frame_num += chunk_size
-            print( "C:{0:08d} F:{1:s} ({2:5.1f}%) L:{3:09d} R:{4:09d} total:{5:d} frac:{6:f}".format(
+            # count adjacent duplicates, the run state carries over chunk boundaries
+            self._find_runs( left,  left_state,  frame )
+            self._find_runs( right, right_state, frame )
+            left_count  = left_state ["dups"]
+            right_count = right_state["dups"]
+
+            frame_num = frame + len( chunk ) - lead_frames
+            self._progress( "score", frame_num, nframes, lambda:
+                "C:{0:08d} F:{1:s} ({2:5.1f}%) L:{3:09d} R:{4:09d} total:{5:d} frac:{6:f}".format(
                 chunk_num, self.sample_to_time( frame_num ), 100.0 * frame_num / nframes,
                 left_count, right_count,
-                (left_count+right_count), (left_count+right_count) / (2.0*frame_num) ),
-                   end='\r', flush=True)
+                (left_count+right_count), (left_count+right_count) / (2.0*frame_num) ))
 
         print("\n")
         print( "dropout score: {0:s} frames:{1:d} L:{2:d} R:{3:d} total:{4:d} frac:{5:f}".format(
             filename, nframes, left_count, right_count,
             (left_count+right_count), (left_count+right_count) / (2.0*nframes) ))
-        
-        # close file
-        wav.close()
 
+        self._stage_done( "score", t0, nframes, nframes * file[ "nchannels" ] * file[ "sampwidth" ] )
         return (left_count, right_count)
     # END DAT_Fix.dropout_score_chunk()
 
     def dropout_score( self, file ):
-        return self.dropout_score_chunk( file )
-        
-    def median_3( self, file_list ):
         """
-        " take three copies of a file
-        " and use a median filter to eliminate dropouts where possible
+        " dropout score of a file, as found by analyze()
+        " the file is only scanned if it hasn't been analyzed yet
+        """
+        if "dropout_score" not in file:
+            self.analyze( file )
+        return file[ "dropout_score" ]
+    # END DAT_Fix.dropout_score()
+
+    def analyze( self, file, thresh=100 ):
+        """
+        " single pass analysis of a take: leader, trailer, dropout score
+        " and dropout regions are all found in one read of the file, so later
+        " stages can use the results rather than scanning the file again.
         "
-        " Note: this is fairly fast and shows some improvement, 
-        " but can sometimes propagate errors
+        " The results are saved in a sidecar file next to the take, and a later
+        " analyze() of the unchanged file loads them without reading the audio.
+        "
+        " inputs:
+        "   file{} - file info dictionary provided by get_file_info()
+        "   thresh - optional - runs of more than thresh equal samples are dropouts
+        "
+        " outputs:
+        "   file[ "leader_length" ]  - count of initial zero frames in the file
+        "   file[ "trailer_length" ] - count of final zero frames in the file
+        "   file[ "dropout_score" ]  - tuple (l, r) count of duplicate adjacent samples between the leader
+        "                              and the trailer, as returned by dropout_score_chunk()
+        "   file[ "runs" ]           - DROPOUT_DTYPE array of every run of more than file[ "run_min" ] equal
+        "                              samples in the file, in frame order. The scan starts from a virtual
+        "                              zero sample, so a run of zeros at the start of the file starts at -1
+        "   file[ "run_min" ]        - shortest run in file[ "runs" ] is run_min + 1 samples
+        "   file[ "dropouts" ]       - DROPOUT_DTYPE array of the runs of more than thresh equal
+        "                              samples between the leader and the trailer, in frame order
+        "   file[ "thresh" ]         - the thresh used for file[ "dropouts" ]
+        "   file[ "dup_hist" ]       - per channel histogram of duplicate runs between the leader and the trailer,
+        "                              see _hist_done(). dropout_count() uses it to answer any thresh
+        """
+        self._analyze( file, thresh )
+        self.framerate = file[ "framerate" ]
+
+        # local copies of file parameters
+        filename     = file[ "name" ]
+        nchannels    = file[ "nchannels" ]
+        nframes      = file[ "nframes" ]
+        lead_frames  = file[ "leader_length" ]
+        trail_frames = file[ "trailer_length" ]
+        score        = file[ "dropout_score" ]
+        dropouts     = file[ "dropouts" ]
+
+        print( "\n{0:s}  total frames:{1:d} leader: {2:d} trailer: {3:d} net frames:{4:d}".format(
+            filename, nframes, lead_frames, trail_frames, nframes - lead_frames - trail_frames ))
+        print( "dropout score: {0:s} frames:{1:d} L:{2:d} R:{3:d} total:{4:d} frac:{5:f}".format(
+            filename, nframes - lead_frames - trail_frames, score[0], score[-1],
+            sum( score ), sum( score ) / max( 1.0, nchannels * ( nframes - lead_frames - trail_frames ) ) ))
+        print( "dropouts: {0:s} thresh:{1:d} count:{2:d} frames:{3:d}".format(
+            filename, thresh, len( dropouts ), int( dropouts[ "length" ].sum() ) ))
+        for t in ( 100, 50, 25, 20 ):
+            print( "  thresh:{0:3d}".format( t ) + "".join(
+                " {0:s}:{1:d} ({2:d} samples)".format( "LR"[c] if nchannels == 2 else str(c), d, s )
+                for (c, (d, s)) in enumerate( self.dropout_count( file, t ) ) ))
+    # END DAT_Fix.analyze()
+
+    def analyze_takes( self, file_list, thresh=100, jobs=1 ):
+        """
+        " get_file_info() and analyze() for each take, with jobs > 1 the takes
+        " are analyzed at the same time in separate worker processes
+        "
+        " each worker's output is collected and printed in one piece when the take
+        " is done, with a line counting the takes finished, rather than several
+        " workers overwriting each other's progress lines
+        "
+        " inputs:
+        "   file_list - list of file info dicts, only file[ "name" ] is needed
+        "   thresh    - optional - dropout threshold for analyze()
+        "   jobs      - optional - number of worker processes
+        "
+        " outputs:
+        "   the file info dicts in file_list are filled in, in place
+        """
+        if jobs <= 1 or len( file_list ) < 2:
+            for file in file_list:
+                self.get_file_info( file )
+                self.analyze( file, thresh )
+            return
+
+        t0 = self._stage_start()
+        workers = {}
+        with ProcessPoolExecutor( max_workers=min( jobs, len( file_list ) ) ) as pool:
+            futures = { pool.submit( _analyze_worker, file[ "name" ], thresh, self.use_cache ): i
+                        for (i, file) in enumerate( file_list ) }
+            done = 0
+            for future in as_completed( futures ):
+                (info, log, metrics) = future.result()
+                file_list[ futures[ future ] ].update( info )
+                for (stage, m) in metrics.items():
+                    totals = workers.setdefault( stage, { "calls":0, "seconds":0.0, "frames":0, "bytes":0 } )
+                    for key in m:
+                        totals[ key ] += m[ key ]
+                done += 1
+                print( log, end='' )
+                print( "analyzed {0:d}/{1:d}: {2:s}".format( done, len( file_list ), info[ "name" ] ) )
+
+        # the workers ran at the same time, so their seconds add up to more than the time it took.
+        # The wall time of the pool is shared out between the stages in proportion to their seconds
+        wall = time.perf_counter() - t0
+        busy = sum( m[ "seconds" ] for m in workers.values() )
+        for (stage, m) in workers.items():
+            totals = self.metrics.setdefault( stage, { "calls":0, "seconds":0.0, "frames":0, "bytes":0 } )
+            for key in ( "calls", "frames", "bytes" ):
+                totals[ key ] += m[ key ]
+            totals[ "seconds" ] += wall * m[ "seconds" ] / busy if busy > 0 else 0.0
+
+        self.framerate = file_list[0][ "framerate" ]
+    # END DAT_Fix.analyze_takes()
+
+    def _analyze( self, file, thresh ):
+        """
+        " internal function used by DAT_Fix.analyze() and DAT_Fix.scan_file()
+        " load the analysis from the sidecar if it is current, otherwise scan the file
+        """
+        if not ( self.use_cache and self._load_sidecar( file, thresh ) ):
+            self._analyze_pass( file, max( 1, min( thresh, RUN_MIN ) ) )
+            if self.use_cache:
+                self._save_sidecar( file )
+        self._select_dropouts( file, thresh )
+    # END DAT_Fix._analyze()
+
+    def _select_dropouts( self, file, thresh ):
         """
+        " internal function used by DAT_Fix._analyze() and DAT_Fix.plan_fill()
+        " pick the dropouts for thresh out of the run table
+        """
+        if file[ "run_min" ] > max( thresh, 1 ): # the table doesn't go down to thresh
+            self._analyze( file, thresh )
+            return
+
+        # the dropouts are the runs between the leader and the trailer,
+        # runs reaching into either are trimmed to the program
+        dropouts = file[ "runs" ].copy()
+        ends = np.minimum( dropouts[ "start" ] + dropouts[ "length" ], file[ "nframes" ] - file[ "trailer_length" ] )
+        dropouts[ "start" ]  = np.maximum( dropouts[ "start" ], file[ "leader_length" ] )
+        dropouts[ "length" ] = ends - dropouts[ "start" ]
+
+        file[ "dropouts" ] = dropouts[ dropouts[ "length" ] > thresh ]
+        file[ "thresh" ]   = thresh
+        file.pop( "dup_cum", None )
+    # END DAT_Fix._select_dropouts()
+
+    def _analyze_pass( self, file, run_min ):
+        """
+        " internal function used by DAT_Fix.analyze()
+        " the single read of the file, see analyze() for the outputs
+        "
+        " with self.jobs > 1 the file is split into segments that are scanned at the same
+        " time in worker processes, each through its own mapping of the file. Runs that
+        " cross from one segment into the next are joined up afterwards, see _scan_segment(),
+        " so the results are the same as for a single scan
+        "
+        " the block digests, see block_digests(), are hashed in the same pass. Their blocks are
+        " counted from the end of the leader, so the leader is found first, which only reads
+        " the leader itself
+        """
+        t0 = self._stage_start()
         # local copies of file parameters
-        filename_1    = file_list[0][ "name" ]
-        filename_2    = file_list[1][ "name" ]
-        filename_3    = file_list[2][ "name" ]
-        nframes_1     = file_list[0][ "nframes" ]
-        nframes_2     = file_list[1][ "nframes" ]
-        nframes_3     = file_list[2][ "nframes" ]
-        lead_frames_1 = file_list[0][ "leader_length" ]
-        lead_frames_2 = file_list[1][ "leader_length" ]
-        lead_frames_3 = file_list[2][ "leader_length" ]
+        nchannels = file[ "nchannels" ]
+        nframes   = file[ "nframes" ]
 
-        sampwidth = file_list[0][ "sampwidth" ]
-        framerate = file_list[0][ "framerate" ]
+        self.framerate = file[ "framerate" ]
 
-        wav_1 = wave.open ( filename_1, "r")
-        wav_2 = wave.open ( filename_2, "r")
-        wav_3 = wave.open ( filename_3, "r")
+        # the first frame with a non-zero sample
+        origin = nframes
+        for (frame_num, chunk) in self.iter_blocks( file, 0, nframes ):
+            active = np.flatnonzero( chunk.any( axis=1 ) )
+            if len( active ) > 0:
+                origin = int( frame_num + active[0] )
+                break
 
+        # segment boundaries, on digest block boundaries and no shorter than SEGMENT_MIN
+        nsegments = max( 1, min( self.jobs, nframes // SEGMENT_MIN ) )
+        bounds = sorted( { 0, nframes } | { origin + max( 0, nframes * i // nsegments - origin ) // DIGEST_FRAMES * DIGEST_FRAMES
+                                            for i in range( 1, nsegments ) if origin < nframes } )
+        nsegments = len( bounds ) - 1
 
-        # ceil( nframes / CHUNK)
-        # thanks to https://stackoverflow.com/questions/14822184/is-there-a-ceiling-equivalent-of-operator-in-python
-        # ceil ( a /b ) == -( -a // b)
-        nframes = min( (nframes_1 - lead_frames_1), (nframes_2 - lead_frames_2), (nframes_3 - lead_frames_3) )
-        num_chunks = -( -nframes // CHUNK )
-        
-        #num_chunks_1 = -( -( nframes_1 - lead_frames_1 ) // CHUNK )
-        #num_chunks_2 = -( -( nframes_2 - lead_frames_2 ) // CHUNK )
-        #num_chunks_3 = -( -( nframes_3 - lead_frames_3 ) // CHUNK )
+        if nsegments == 1:
+            segments = [ self._scan_segment( file, 0, nframes, run_min, origin, progress=True ) ]
+        else:
+            info = { key:file[ key ] for key in ( "name", "nchannels", "sampwidth", "framerate", "nframes", "data_offset" ) }
+            segments = [ None ] * nsegments
+            with ProcessPoolExecutor( max_workers=nsegments ) as pool:
+                futures = { pool.submit( _scan_segment_worker, info, bounds[i], bounds[i + 1], run_min, origin ): i
+                            for i in range( nsegments ) }
+                for future in as_completed( futures ):
+                    segments[ futures[ future ] ] = future.result()
+                    scanned = sum( s is not None for s in segments )
+                    self._progress( "scan", scanned, nsegments, lambda: "{0:s}  segments scanned: {1:d}/{2:d}".format(
+                        file[ "name" ], scanned, nsegments ))
+
+        # join the runs crossing segment boundaries: the run open at the end of one segment
+        # continues with the first run of the next. Scanning starts from a virtual zero sample
+        runs   = []
+        hists  = [ self._hist_init() for c in range( nchannels ) ]
+        joined = [ [] for c in range( nchannels ) ]
+        states = [ { "prev":0, "start":-1, "length":1, "dups":0 } for c in range( nchannels ) ]
+
+        for segment in segments:
+            runs.extend( segment[ "runs" ] )
+            for c in range( nchannels ):
+                self._hist_merge( hists[c], segment[ "hists" ][c] )
+                states[c]["dups"] += segment[ "dups" ][c]
+
+                (start, length, value) = segment[ "tails" ][c]
+                if segment[ "heads" ][c] is None: # the open run continues through the whole segment
+                    states[c]["length"] += length - 1
+                    continue
+
+                # the head repeats the last frame of the previous segment
+                joined[c].append( ( states[c]["start"], states[c]["length"] + segment[ "heads" ][c][1] - 1,
+                                    states[c]["prev"] ) )
+                states[c].update( prev=value, start=start, length=length )
+
+        # frames with any non-zero sample bound the leader and trailer
+        active = [ s for s in segments if s[ "last_frame" ] >= 0 ]
+        lead_frames = active[0][ "lead_frames" ] if active else nframes
+        last_frame  = active[-1][ "last_frame" ] if active else -1
+        last_values = active[-1][ "last_values" ] if active else np.zeros( nchannels, dtype=np.int16 )
+
+        for c in range( nchannels ):
+            if len( joined[c] ):
+                (starts, lengths, values) = ( np.array( column ) for column in zip( *joined[c] ) )
+                long_runs = lengths > run_min
+                if long_runs.any():
+                    runs.append( ( c, starts[long_runs], lengths[long_runs], values[long_runs] ) )
+
+                # duplicates in each run, the one starting in the leader only counts those after it
+                dups = lengths - 1
+                dups[ starts == -1 ] -= lead_frames
+                self._hist_add( hists[c], dups )
+
+        # catch "hanging" runs at end of file
+        for c in range( nchannels ):
+            if states[c]["length"] > run_min:
+                runs.append( ( c, np.array( [states[c]["start"]] ), np.array( [states[c]["length"]] ),
+                               np.array( [states[c]["prev"]] ) ) )
+
+        trail_frames = nframes - 1 - last_frame if last_frame >= 0 else 0
+
+        # duplicates in the trailer: every trailer frame repeats the zero before it,
+        # except the first where the last program sample isn't zero
+        trail_dups = [ trail_frames - 1 + int( last_values[c] == 0 ) if trail_frames > 0 else 0
+                       for c in range( nchannels ) ]
+
+        # the open run at the end of each channel holds the trailer
+        for c in range( nchannels ):
+            dups = states[c]["length"] - 1 - trail_dups[c]
+            if states[c]["start"] == -1:
+                dups -= lead_frames
+            self._hist_add( hists[c], np.array( [dups] ) )
+
+        # collect the run table
+        table = np.empty( sum( len( r[1] ) for r in runs ), dtype=DROPOUT_DTYPE )
+        n = 0
+        for (c, starts, lengths, values) in runs:
+            table[ "channel" ][ n : n + len( starts ) ] = c
+            table[ "start" ]  [ n : n + len( starts ) ] = starts
+            table[ "length" ] [ n : n + len( starts ) ] = lengths
+            table[ "value" ]  [ n : n + len( starts ) ] = values
+            n += len( starts )
+        table = table[ np.lexsort( ( table[ "channel" ], table[ "start" ] ) ) ]
+
+        # every leader frame was counted as a duplicate of the one before it
+        score = tuple( int( states[c]["dups"] ) - lead_frames - trail_dups[c] for c in range( nchannels ) )
+
+        file[ "leader_length" ]  = int( lead_frames )
+        file[ "trailer_length" ] = int( trail_frames )
+        file[ "dropout_score" ]  = score
+        file[ "runs" ]           = table
+        file[ "run_min" ]        = run_min
+        file[ "dup_hist" ]       = [ self._hist_done( hists[c] ) for c in range( nchannels ) ]
+        file[ "digests" ]        = np.array( [ d for segment in segments for d in segment[ "digests" ] ], dtype=np.uint64 )
+        self._stage_done( "scan", t0, nframes, nframes * nchannels * file[ "sampwidth" ] )
+    # END DAT_Fix._analyze_pass()
+
+    def _scan_segment( self, file, first, last, run_min, origin, progress=False ):
+        """
+        " internal function used by DAT_Fix._analyze_pass()
+        "
+        " scan frames [first, last) of a file. The scan starts from the frame before the
+        " segment, so duplicates are counted exactly, but the run that frame belongs to
+        " is only known to the segments before this one. The first run completed in the
+        " segment is therefore returned as the head, and the run still open at the end as the
+        " tail, and _analyze_pass() joins them up with the neighbouring segments
+        "
+        " the digest blocks are counted from origin, the end of the leader. A segment starts
+        " on a block boundary, or before origin, and ends on one, or at the end of the file
+        "
+        " outputs:
+        "   dict with
+        "   "heads"  - per channel (start, length, value) of the first run completed, counting
+        "              the frame before the segment, or None if no run was completed
+        "   "tails"  - per channel (start, length, value) of the run open at the end of the segment
+        "   "runs"   - list of (channel, starts, lengths, values) of the other runs of more than run_min
+        "   "hists"  - per channel duplicate histogram of the other runs, see _hist_done()
+        "   "dups"   - per channel count of samples equal to the one before them
+        "   "lead_frames", "last_frame", "last_values" - first and last frames with a non-zero sample
+        "              in the segment, -1 if there are none, and the samples of the last one
+        "   "digests" - list of the digests of the blocks in the segment
+        """
+        nchannels = file[ "nchannels" ]
+        nframes   = last - first
 
-        #num_chunks = min( num_chunks_1, num_chunks_2, num_chunks_3 )
-        
-        nchannels = 2
+        samples = self._map_samples( file )
 
-        # prepare the output file
-        wav_out = wave.open( "out.wav", 'wb' )
-        wav_out.setnchannels( nchannels )
-        wav_out.setsampwidth( sampwidth )
-        wav_out.setframerate( framerate )
-        wav_out.setnframes( nframes )
-        
-        
-        # fast forward through lead_frames
-        wav_1.readframes ( lead_frames_1 )
-        wav_2.readframes ( lead_frames_2 )
-        wav_3.readframes ( lead_frames_3 )
+        if first == 0: # virtual zero sample before the file
+            prev = np.zeros( nchannels, dtype=np.int16 )
+        else:
+            prev = samples[ first - 1 ]
+        states = [ { "prev":prev[c], "start":first - 1, "length":1, "dups":0 } for c in range( nchannels ) ]
+
+        heads = [ None ] * nchannels
+        runs  = []
+        hists = [ self._hist_init() for c in range( nchannels ) ]
+        lead_frames = -1
+        last_frame  = -1
+        last_values = np.zeros( nchannels, dtype=np.int16 )
+        digests = []
+        hasher  = None
+
+        for (chunk_num, (frame_num, chunk)) in enumerate( self.iter_blocks( file, first, last ) ):
+            # hash the chunk into the digest blocks it covers, a block may span chunks
+            a = max( frame_num, origin )
+            end = frame_num + len( chunk )
+            while a < end:
+                b = min( end, origin + ( ( a - origin ) // DIGEST_FRAMES + 1 ) * DIGEST_FRAMES )
+                if hasher is None:
+                    hasher = hashlib.blake2b( digest_size=8 )
+                hasher.update( chunk[ a - frame_num : b - frame_num ].tobytes() )
+                if ( b - origin ) % DIGEST_FRAMES == 0:
+                    digests.append( int.from_bytes( hasher.digest(), "little" ) )
+                    hasher = None
+                a = b
+
+            active = np.flatnonzero( chunk.any( axis=1 ) )
+            if len( active ) > 0:
+                if lead_frames < 0:
+                    lead_frames = int( frame_num + active[0] )
+                last_frame  = int( frame_num + active[-1] )
+                last_values = chunk[ active[-1] ].copy()
+
+            for c in range( nchannels ):
+                (starts, lengths, values) = self._find_runs( chunk[:, c], states[c], frame_num )
+                if heads[c] is None and len( starts ) > 0:
+                    heads[c] = ( int( starts[0] ), int( lengths[0] ), values[0] )
+                    (starts, lengths, values) = ( starts[1:], lengths[1:], values[1:] )
+
+                long_runs = lengths > run_min
+                if long_runs.any():
+                    runs.append( ( c, starts[long_runs], lengths[long_runs], values[long_runs] ) )
+                self._hist_add( hists[c], lengths - 1 )
+
+            if progress:
+                done = frame_num + len( chunk )
+                self._progress( "scan", done - first, nframes, lambda: "C:{0:08d} F:{1:s} ({2:5.1f}%)".format(
+                    chunk_num, self.sample_to_time( done ), 100.0 * ( done - first ) / nframes ))
+
+        # the shorter last block of the file
+        if hasher is not None:
+            digests.append( int.from_bytes( hasher.digest(), "little" ) )
+
+        return { "heads":heads,
+                 "tails":[ ( states[c]["start"], states[c]["length"], states[c]["prev"] ) for c in range( nchannels ) ],
+                 "runs":runs,
+                 "hists":[ self._hist_done( hists[c] ) for c in range( nchannels ) ],
+                 "dups":[ int( states[c]["dups"] ) for c in range( nchannels ) ],
+                 "lead_frames":lead_frames, "last_frame":last_frame, "last_values":last_values,
+                 "digests":digests }
+    # END DAT_Fix._scan_segment()
+
+    def _sidecar_key( self, file ):
+        """
+        " internal function used by the sidecar functions
+        "
+        " identity of a wave file: size, modification time and a hash of the header
+        " and of SIDECAR_HASH_BYTES at each end of the data, so that a changed file
+        " is noticed without reading all of it
+        """
+        stat = os.stat( file[ "name" ] )
+        data_len = file[ "nframes" ] * file[ "nchannels" ] * file[ "sampwidth" ]
 
-        # scan file for differences
-        frame_num = 0
-        
-        for chunk_num in range( num_chunks ):
+        digest = hashlib.sha1()
+        with open( file[ "name" ], "rb" ) as f:
+            digest.update( f.read( file[ "data_offset" ] + min( data_len, SIDECAR_HASH_BYTES ) ) )
+            if data_len > SIDECAR_HASH_BYTES:
+                tail = max( SIDECAR_HASH_BYTES, data_len - SIDECAR_HASH_BYTES )
+                f.seek( file[ "data_offset" ] + tail )
+                digest.update( f.read( data_len - tail ) )
 
-            # handle possibly odd sized last chunk
-            if frame_num + CHUNK > nframes:
-                chunk_size = nframes - chunk_num*CHUNK
-            else:
-                chunk_size = CHUNK
-
-            # read the next chunk
-            chunk = wav_1.readframes ( chunk_size )
-            out = struct.unpack_from ( "%dh" % nchannels * chunk_size, chunk )
-
-            # Convert 2 channels to numpy arrays and analyze for drop-outs
-            left_1  = np.array (list ( out[0::2] ))
-            right_1 = np.array (list ( out[1::2] ))
-
-            chunk = wav_2.readframes ( chunk_size )
-            out = struct.unpack_from ( "%dh" % nchannels * chunk_size, chunk )
-            left_2  = np.array (list ( out[0::2] ))
-            right_2 = np.array (list ( out[1::2] ))
-
-            chunk = wav_3.readframes ( chunk_size )
-            out = struct.unpack_from ( "%dh" % nchannels * chunk_size, chunk )
-            left_3  = np.array (list ( out[0::2] ))
-            right_3 = np.array (list ( out[1::2] ))
-
-            left  = np.array( [left_1,  left_2,  left_3] )
-            right = np.array( [right_1, right_2, right_3] )
-
-            # use numpy.median() to find "majority vote" of the three samples
-            left_m  = np.median( left,  axis=0)
-            right_m = np.median( right, axis=0)
-
-            #chunk_corrected = np.array[ zip( left_m, right_m ) ]
-            for (l, r ) in zip (left_m, right_m ):
-                wav_out.writeframesraw( struct.pack('<hh', int(l), int(r) ) )
-            
-            frame_num += chunk_size
-            print( "C:{0:08d} F:{1:09d}".format( chunk_num, frame_num ), end='\r', flush=True)
-
-        # close file
-        wav_1.close()
-        wav_2.close()
-        wav_3.close()
-        wav_out.close()
-    # END DAT_Fix.median_3()
+        return { "size":stat.st_size, "mtime_ns":stat.st_mtime_ns, "hash":digest.hexdigest() }
+    # END DAT_Fix._sidecar_key()
+
+    def _save_sidecar( self, file ):
+        """
+        " internal function used by DAT_Fix.analyze()
+        "
+        " save the header parameters and analysis of a file in a compact .npz next to it.
+        " failing to write it (read only archive) is not an error, the file is just analyzed again next time
+        """
+        sidecar = dict( self._sidecar_key( file ), version=SIDECAR_VERSION )
+        for key in ( "nchannels", "sampwidth", "framerate", "nframes", "data_offset",
+                     "leader_length", "trailer_length", "dropout_score", "runs", "run_min" ):
+            sidecar[ key ] = np.asarray( file[ key ] )
+        for c in range( file[ "nchannels" ] ):
+            sidecar[ "dup_hist_{0:d}".format( c ) ] = file[ "dup_hist" ][ c ]
+        sidecar[ "digests" ] = file[ "digests" ]
+        sidecar[ "digest_frames" ] = np.asarray( DIGEST_FRAMES )
+
+        # write a temporary file and rename it, so a crash never leaves a partial sidecar
+        name = file[ "name" ] + SIDECAR_EXT
+        try:
+            with open( name + ".tmp", "wb" ) as f:
+                np.savez( f, **sidecar )
+            os.replace( name + ".tmp", name )
+        except OSError as e:
+            print( "\ncan't save analysis to {0:s}: {1:s}".format( name, str( e ) ) )
+    # END DAT_Fix._save_sidecar()
+
+    def _load_sidecar( self, file, thresh ):
+        """
+        " internal function used by DAT_Fix.analyze()
+        "
+        " load the analysis of a file from its sidecar, if there is one, it matches the
+        " file and its run table goes down to thresh. Only the header and sidecar are read.
+        "
+        " outputs:
+        "   True if the analysis was loaded into file{}
+        """
+        name = file[ "name" ] + SIDECAR_EXT
+        if not os.path.exists( name ):
+            return False
+
+        try:
+            with np.load( name, allow_pickle=False ) as sidecar:
+                if ( int( sidecar[ "version" ] ) != SIDECAR_VERSION or int( sidecar[ "run_min" ] ) > max( thresh, 1 )
+                     or int( sidecar[ "digest_frames" ] ) != DIGEST_FRAMES ):
+                    return False
+                for (key, value) in self._sidecar_key( file ).items():
+                    if sidecar[ key ].item() != value:
+                        return False
+                for key in ( "nchannels", "sampwidth", "framerate", "nframes", "data_offset" ):
+                    if int( sidecar[ key ] ) != file[ key ]:
+                        return False
+
+                file[ "leader_length" ]  = int( sidecar[ "leader_length" ] )
+                file[ "trailer_length" ] = int( sidecar[ "trailer_length" ] )
+                file[ "dropout_score" ]  = tuple( int( s ) for s in sidecar[ "dropout_score" ] )
+                file[ "runs" ]           = sidecar[ "runs" ]
+                file[ "run_min" ]        = int( sidecar[ "run_min" ] )
+                file[ "dup_hist" ]       = [ sidecar[ "dup_hist_{0:d}".format( c ) ]
+                                             for c in range( file[ "nchannels" ] ) ]
+                file[ "digests" ]        = sidecar[ "digests" ]
+        except ( OSError, ValueError, KeyError ) as e:
+            print( "\nignoring {0:s}: {1:s}".format( name, str( e ) ) )
+            return False
+
+        return True
+    # END DAT_Fix._load_sidecar()
+
+    def _hist_init( self ):
+        """
+        " internal function used by DAT_Fix.analyze()
+        " empty duplicate run histogram, run lengths are buffered and binned in batches
+        """
+        return { "dense":np.zeros( 0, dtype=np.int64 ), "long":{}, "pending":[], "size":0 }
+    # END DAT_Fix._hist_init()
 
+    def _hist_add( self, hist, dups ):
+        """
+        " internal function used by DAT_Fix.analyze()
+        " add runs with dups duplicated samples each to a histogram, runs with no duplicates are ignored
+        """
+        dups = dups[ dups > 0 ]
+        hist[ "pending" ].append( dups )
+        hist[ "size" ] += len( dups )
+        if hist[ "size" ] < CHUNK * 64:
+            return
+
+        dups = np.concatenate( hist[ "pending" ] )
+        hist[ "pending" ] = []
+        hist[ "size" ] = 0
+
+        for d in dups[ dups >= HIST_DENSE ]: # rare, very long runs
+            hist[ "long" ][ int( d ) ] = hist[ "long" ].get( int( d ), 0 ) + 1
+        counts = np.bincount( dups[ dups < HIST_DENSE ] )
+        if len( counts ) > len( hist[ "dense" ] ):
+            counts[ :len( hist[ "dense" ] ) ] += hist[ "dense" ]
+            hist[ "dense" ] = counts
+        else:
+            hist[ "dense" ][ :len( counts ) ] += counts
+    # END DAT_Fix._hist_add()
 
-    def do_scan_and_fill_2( self, file_list, thresh=100 ):
+    def _hist_done( self, hist ):
         """
-        " look for dropouts in file 1 where sample values are duplicated 
-        " for more than thresh samples, and then attempt to fill them from
-        " another file if there duplicate sample run length is less.
+        " internal function used by DAT_Fix.analyze()
         "
-        " This should work well for dropouts where the level is held constant
-        " and successive takes yield shorter dropouts or dropouts in different areas.
+        " outputs:
+        "   compact histogram - int64 array of shape (2, n), row 0 holds the distinct
+        "   numbers of duplicated samples in a run, in increasing order,
+        "   and row 1 the number of runs of each length
+        """
+        hist[ "size" ] = CHUNK * 64 # flush what is pending
+        self._hist_add( hist, np.zeros( 0, dtype=np.int64 ) )
+
+        lengths = np.flatnonzero( hist[ "dense" ] )
+        long_lengths = sorted( hist[ "long" ] )
+        return np.array( [ np.concatenate( ( lengths, np.array( long_lengths, dtype=np.int64 ) ) ),
+                           np.concatenate( ( hist[ "dense" ][ lengths ],
+                                             np.array( [ hist[ "long" ][d] for d in long_lengths ], dtype=np.int64 ) ) ) ],
+                         dtype=np.int64 )
+    # END DAT_Fix._hist_done()
+
+    def _hist_merge( self, hist, compact ):
+        """
+        " internal function used by DAT_Fix._analyze_pass()
+        " add a compact histogram from _hist_done() to a histogram
+        """
+        (lengths, counts) = compact
+        dense = lengths < HIST_DENSE
+        if dense.any():
+            size = int( lengths[dense][-1] ) + 1
+            if size > len( hist[ "dense" ] ):
+                hist[ "dense" ] = np.concatenate( ( hist[ "dense" ], np.zeros( size - len( hist[ "dense" ] ), dtype=np.int64 ) ) )
+            hist[ "dense" ][ lengths[dense] ] += counts[dense]
+        for (d, n) in zip( lengths[~dense], counts[~dense] ):
+            hist[ "long" ][ int( d ) ] = hist[ "long" ].get( int( d ), 0 ) + int( n )
+    # END DAT_Fix._hist_merge()
+
+    def dropout_count( self, file, thresh ):
+        """
+        " count the dropouts in an analyzed file for any thresh, without scanning it again
         "
-        " this will not work for noisy dropouts where the value changes rapidly.
+        " a cumulative view of the duplicate run histogram from analyze() is built once,
+        " after that each thresh is a lookup
         "
         " inputs:
-        "    file_list: list of file info dicts provided by get_file_info() function
-        "               requires two files
-        "               TODO: this reall needs two and only two files, specify directly rather than as a list?
-        "    thresh:    optional - specify threshold dropout size to fill
+        "   file{} - file info dictionary, after analyze()
+        "   thresh - count runs of more than thresh duplicated samples, as reported by scan_file()
         "
         " outputs:
-        "    out.wav:   merged file
+        "   list of (dropouts, samples) tuples, one per channel - the number of runs of
+        "   more than thresh duplicates, and the total of the duplicated samples in them
         """
-        # local copies of file parameters
-        filename_master    = file_list[0][ "name" ]
-        filename_donor     = file_list[1][ "name" ]
-
-        nframes_master     = file_list[0][ "nframes" ]
-        nframes_donor      = file_list[1][ "nframes" ]
-
-        lead_frames_master = file_list[0][ "leader_length" ]
-        lead_frames_donor  = file_list[1][ "leader_length" ]
+        if "dup_cum" not in file:
+            # runs and samples in runs at least as long as each histogram entry, with a zero entry at the end
+            file[ "dup_cum" ] = []
+            for (lengths, counts) in file[ "dup_hist" ]:
+                file[ "dup_cum" ].append( ( lengths,
+                    np.concatenate( ( np.cumsum( counts[::-1] )[::-1], [0] ) ),
+                    np.concatenate( ( np.cumsum( ( lengths * counts )[::-1] )[::-1], [0] ) ) ) )
+
+        result = []
+        for (lengths, runs, samples) in file[ "dup_cum" ]:
+            i = np.searchsorted( lengths, thresh, side="right" )
+            result.append( ( int( runs[i] ), int( samples[i] ) ) )
+        return result
+    # END DAT_Fix.dropout_count()
+
+    def print_dropouts( self, file ):
+        """
+        " print the dropout regions found by analyze(), one per line
+        """
+        self.framerate = file[ "framerate" ]
+        for d in file[ "dropouts" ]:
+            print( "{0:s} Start {1:s} {2:5d} Dur {3:s}".format(
+                "LR"[ d["channel"] ] if file[ "nchannels" ] == 2 else str( d["channel"] ),
+                self.sample_to_time( d["start"] ), int( d["value"] ), self.sample_to_time( d["length"] ) ))
+    # END DAT_Fix.print_dropouts()
+
+    def export_events( self, events, fname, framerate ):
+        """
+        " save dropouts for other tools, as JSON lines, or CSV if fname ends in .csv
+        "
+        " inputs:
+        "   events    - DROPOUT_DTYPE array, from scan_file() or dropout_events()
+        "   fname     - file to write
+        "   framerate - frames per second of the take, for the time columns
+        "
+        " outputs:
+        "   one record per dropout: channel, start (the first duplicated sample), length (the number
+        "   of duplicates), value (the held sample), and the start in seconds and as the time
+        "   printed by the tools, e.g. 012m34s+01234samp
+        """
+        self.framerate = framerate
+        fields = [ "channel", "start", "length", "value", "seconds", "time" ]
+
+        with open( fname, "w", newline="" ) as f:
+            if fname.lower().endswith( ".csv" ):
+                writer = csv.writer( f )
+                writer.writerow( fields )
+            for event in events:
+                start = int( event[ "start" ] )
+                record = [ int( event[ "channel" ] ), start, int( event[ "length" ] ), int( event[ "value" ] ),
+                           start / framerate, self.sample_to_time( start ).split()[-1] ]
+                if fname.lower().endswith( ".csv" ):
+                    writer.writerow( record )
+                else:
+                    f.write( json.dumps( dict( zip( fields, record ) ) ) + "\n" )
+    # END DAT_Fix.export_events()
 
-        sampwidth = file_list[0][ "sampwidth" ]
-        framerate = file_list[0][ "framerate" ]
+    def block_digests( self, file ):
+        """
+        " digests of the program of a take, in blocks of DIGEST_FRAMES frames counted from
+        " the end of the leader. Takes should be byte identical apart from their dropouts,
+        " so the multi-take functions compare digests first and only work on the blocks
+        " that differ, see _same_blocks()
+        "
+        " inputs:
+        "   file{} - file info dictionary, after analyze()
+        "
+        " outputs:
+        "   file[ "digests" ] - uint64 array, the 8 byte blake2b digest of each block up to the
+        "                       end of the file, the last block may be shorter
+        "
+        " the digests are hashed by the analysis pass, see _scan_segment(), and saved in the
+        " sidecar with the rest of the analysis, so they cost no read of their own
+        """
+        if "digests" not in file:
+            self._analyze( file, file.get( "thresh", 100 ) )
+        return file[ "digests" ]
+    # END DAT_Fix.block_digests()
 
-        print("dropout threshold: "+str(thresh))
-                   
+    def _skip_same( self, same ):
+        """
+        " internal function used by the multi-take functions
+        " the skip() for iter_takes() from a _same_blocks() mask: True for frames that are
+        " all in blocks that are the same in every take
+        """
+        def skip( first, last ):
+            return last <= len( same ) * DIGEST_FRAMES and bool( same[ first // DIGEST_FRAMES : -( -last // DIGEST_FRAMES ) ].all() )
+        return skip
+    # END DAT_Fix._skip_same()
+
+    def _same_blocks( self, file_list, nframes ):
+        """
+        " internal function used by the multi-take functions
+        "
+        " which blocks of the program are the same in every take, from their block_digests().
+        " A take's blocks only line up with the program's where its offset is a whole number
+        " of blocks, anywhere else, and in the last partial block, the blocks count as different
+        "
+        " outputs:
+        "   bool array, element k for program frames k * DIGEST_FRAMES to (k + 1) * DIGEST_FRAMES
+        """
+        nblocks = max( 0, nframes ) // DIGEST_FRAMES
+        frames  = np.arange( nblocks, dtype=np.int64 ) * DIGEST_FRAMES
+        same    = np.ones( nblocks, dtype=bool )
+        ref     = None
+
+        for file in file_list:
+            digests = self.block_digests( file )
+            if len( digests ) == 0:
+                return np.zeros( nblocks, dtype=bool )
+
+            # the offset has to be the same over the whole block
+            breaks = self._offset_map( file )
+            i = np.maximum( np.searchsorted( breaks[:, 0], frames, side="right" ) - 1, 0 )
+            j = np.maximum( np.searchsorted( breaks[:, 0], frames + DIGEST_FRAMES - 1, side="right" ) - 1, 0 )
+            offset = breaks[ i, 1 ]
+            index  = np.arange( nblocks ) + offset // DIGEST_FRAMES
+            same  &= ( i == j ) & ( offset % DIGEST_FRAMES == 0 ) & ( index >= 0 ) & ( index < len( digests ) )
+
+            block_digest = digests[ np.clip( index, 0, len( digests ) - 1 ) ]
+            if ref is None:
+                ref = block_digest
+            else:
+                same &= block_digest == ref
+
+        return same
+    # END DAT_Fix._same_blocks()
+
+    def align_takes( self, file_list ):
+        """
+        " find the shift between takes, rather than relying on the leader
+        " lengths alone to line them up
+        "
+        " an excerpt from the middle of the first take is located in each of the other
+        " takes, by an exact match of a block from its middle found with a rolling hash or,
+        " failing that, with an FFT cross-correlation of decimated copies, then the shift is
+        " refined sample-exact at full rate by counting equal samples. Only the excerpts are
+        " read, so this takes seconds even on long files
+        "
+        " inputs:
+        "   file_list: list of file info dicts provided by get_file_info() and analyze()
+        "              the first take is the reference
+        "
+        " outputs:
+        "   file[ "offset" ]      - frames to add to file[ "leader_length" ] to line the take up
+        "                           with the others, used by all the multi-take functions
+        "   file[ "align_match" ] - fraction of equal samples at that offset, low values
+        "                           mean the alignment is doubtful
+        "
+        " offsets are adjusted so no take starts before its first frame, so the
+        " reference may get a non-zero offset too
+        """
+        ref = file_list[0]
+        for file in file_list:
+            if "leader_length" not in file:
+                self.analyze( file )
+
+        t0 = self._stage_start()
+
+        ref[ "offset" ] = 0
+        ref[ "align_match" ] = 1.0
+        for file in file_list[1:]:
+            ( file[ "offset" ], file[ "align_match" ] ) = self._find_offset( ref, file )
+
+        # if a take starts later than the reference, skip the start of all of them
+        skip = max( -( file[ "leader_length" ] + file[ "offset" ] ) for file in file_list )
+        for file in file_list:
+            file[ "offset" ] += max( 0, skip )
+            print( "align: {0:s} leader:{1:d} offset:{2:+d} match:{3:5.1f}%".format(
+                file[ "name" ], file[ "leader_length" ], file[ "offset" ], 100.0 * file[ "align_match" ] ))
+            if file[ "align_match" ] < 0.5:
+                print( "  alignment of {0:s} is doubtful".format( file[ "name" ] ))
+
+        # the excerpts compared, roughly
+        frames = ALIGN_SECONDS * ref[ "framerate" ] * len( file_list )
+        self._stage_done( "align", t0, frames, frames * ref[ "nchannels" ] * ref[ "sampwidth" ] )
+    # END DAT_Fix.align_takes()
+
+    def _find_offset( self, ref, file ):
+        """
+        " internal function used by DAT_Fix.align_takes()
+        "
+        " outputs:
+        "   (offset, match) - offset of file relative to ref after trimming the leaders,
+        "                     and the fraction of equal samples at that offset
+        """
+        framerate = ref[ "framerate" ]
+        decimate  = ALIGN_DECIMATE
+        max_shift = ALIGN_SEARCH_SECONDS * framerate
+
+        ref_samples  = self._map_samples( ref ) [ ref[ "leader_length" ]: ]
+        file_samples = self._map_samples( file )[ file[ "leader_length" ]: ]
+
+        # excerpt from the middle of the shorter take, avoiding quiet starts and trailers
+        length = min( ALIGN_SECONDS * framerate, len( ref_samples ), len( file_samples ) ) // decimate * decimate
+        start  = max( 0, min( len( ref_samples ), len( file_samples ) ) // 2 - length // 2 )
+        if length == 0:
+            return ( 0, 0.0 )
+
+        # search window in the other take
+        first = max( 0, start - max_shift )
+        last  = min( len( file_samples ), start + length + max_shift )
+        last  = first + ( last - first ) // decimate * decimate
+
+        # a block from the middle of the excerpt found exactly, once, in the other take gives the
+        # offset directly, otherwise (dropouts in it, silence) search for the excerpt
+        middle = start + length // 2 - DIGEST_FRAMES // 2
+        found = []
+        if length >= DIGEST_FRAMES:
+            found = self._find_block( np.ascontiguousarray( ref_samples[ middle : middle + DIGEST_FRAMES ] ),
+                                      file_samples[ first : last ] )
+        if len( found ) == 1:
+            coarse = first + found[0] - middle
+        else:
+            # decimated mono copies, averaging blocks of frames
+            a = ref_samples[ start : start + length ].astype( np.float32 ).sum( axis=1 )
+            b = file_samples[ first : last ].astype( np.float32 ).sum( axis=1 )
+            a = a.reshape( -1, decimate ).mean( axis=1 )
+            b = b.reshape( -1, decimate ).mean( axis=1 )
+            lag = self._best_lag( a, b )
+            if lag is None:
+                return ( 0, 0.0 )
+            coarse = first + lag * decimate - start
+
+        # refine at full rate, counting equal samples around the coarse offset
+        refine = min( length, framerate )
+        best = ( coarse, -1 )
+        for offset in range( coarse - 2 * decimate, coarse + 2 * decimate + 1 ):
+            if start + offset < 0 or start + offset + refine > len( file_samples ):
+                continue
+            equal = np.count_nonzero( ref_samples[ start : start + refine ] ==
+                                      file_samples[ start + offset : start + offset + refine ] )
+            if equal > best[1]:
+                best = ( offset, equal )
+
+        return ( best[0], max( 0, best[1] ) / float( refine * ref[ "nchannels" ] ) )
+    # END DAT_Fix._find_offset()
+
+    def _rolling_hashes( self, frames, window ):
+        """
+        " internal function used by the alignment functions
+        "
+        " polynomial hash, modulo 2**64, of every run of window frames, all computed in one pass
+        " from a cumulative sum. It is a weak hash, used to find candidate positions of a block
+        " at any shift, which are then checked sample by sample
+        "
+        " outputs:
+        "   uint64 array, element i is the hash of frames[ i : i + window ]
+        """
+        n = len( frames ) - window + 1
+        if n < 1:
+            return np.zeros( 0, dtype=np.uint64 )
+
+        # one number per frame, the channels side by side
+        v = np.zeros( len( frames ), dtype=np.uint64 )
+        for c in range( frames.shape[1] ):
+            v = v * np.uint64( 1 << 16 ) + frames[:, c].view( np.uint16 )
+
+        # prefix sums of v[m] * base**m, then each window is scaled back by base**-i,
+        # numpy integer arithmetic wraps modulo 2**64
+        one     = np.ones( 1, dtype=np.uint64 )
+        powers  = np.concatenate( ( one, np.cumprod( np.full( len( frames ) - 1, ROLL_BASE, dtype=np.uint64 ) ) ) )
+        inverse = np.concatenate( ( one, np.cumprod( np.full( n - 1, pow( ROLL_BASE, -1, 1 << 64 ), dtype=np.uint64 ) ) ) )
+        prefix  = np.concatenate( ( np.zeros( 1, dtype=np.uint64 ), np.cumsum( v * powers, dtype=np.uint64 ) ) )
+        return ( prefix[ window: ] - prefix[ :n ] ) * inverse
+    # END DAT_Fix._rolling_hashes()
+
+    def _find_block( self, block, frames, limit=2 ):
+        """
+        " internal function used by DAT_Fix._find_offset()
+        "
+        " positions where block appears, sample exact, in frames, up to limit of them
+        """
+        target  = self._rolling_hashes( block, len( block ) )
+        hashes  = self._rolling_hashes( frames, len( block ) )
+        found = []
+        for i in np.flatnonzero( hashes == target[:1] ):
+            if np.array_equal( frames[ i : i + len( block ) ], block ):
+                found.append( int( i ) )
+                if len( found ) >= limit:
+                    break
+        return found
+    # END DAT_Fix._find_block()
+
+    def _best_lag( self, a, b ):
+        """
+        " internal function used by the alignment functions
+        "
+        " FFT cross-correlation of signal a at every lag within the longer signal b,
+        " normalized by the energy of b at each lag so loud passages don't win
+        "
+        " outputs:
+        "   lag where a best matches b[ lag : lag + len(a) ], None if b is shorter than a
+        """
+        lags = len( b ) - len( a ) + 1
+        if lags < 1:
+            return None
+
+        a = a - a.mean()
+        b = b - b.mean()
+        size = 1 << int( len( a ) + len( b ) - 1 ).bit_length()
+        corr = np.fft.irfft( np.conj( np.fft.rfft( a, size ) ) * np.fft.rfft( b, size ), size )[ :lags ]
+        energy = np.cumsum( np.concatenate( ( [0.0], b.astype( np.float64 ) ** 2 ) ) )
+        energy = energy[ len( a ): len( a ) + lags ] - energy[ :lags ]
+        corr /= np.sqrt( np.maximum( energy, 1e-9 ) )
+        return int( np.argmax( corr ) )
+    # END DAT_Fix._best_lag()
+
+    def map_drift( self, file_list ):
+        """
+        " follow the alignment of each take through the whole tape, since
+        " playback can drop or repeat frames, and the takes slip out of sync
+        "
+        " the takes are compared with the reference (first take) a window at a time at the
+        " current offset, the whole window and its last DRIFT_PROBE frames. When a window stops
+        " matching, the new offset is searched for near the old one, and the frame where the slip
+        " happened is located within the window or the one before it.
+        " Time is linear in the tape length and memory is bounded by the window size.
+        "
+        " inputs:
+        "   file_list: list of file info dicts, after align_takes()
+        "
+        " outputs:
+        "   file[ "offset_map" ] - int64 array of (frame, offset) breakpoints, in frame order.
+        "                          from each breakpoint frame (counted from the start of the
+        "                          reference program) the take is read with the new offset,
+        "                          see _read_mapped(). The first breakpoint is (0, file[ "offset" ])
+        """
+        ref = file_list[0]
+        if "offset" not in ref:
+            self.align_takes( file_list )
+
+        t0 = self._stage_start()
+
+        framerate  = ref[ "framerate" ]
         self.framerate = framerate
+        window     = DRIFT_WINDOW_SECONDS * framerate
+        probe      = min( DRIFT_PROBE, window )
+        max_slip   = int( DRIFT_MAX_SLIP_SECONDS * framerate )
+        ref_samples = self._map_samples( ref )[ self._program_start( ref ): ]
+        nframes    = len( ref_samples )
+
+        ref[ "offset_map" ] = np.array( [ [0, ref[ "offset" ]] ], dtype=np.int64 )
+        for file in file_list[1:]:
+            samples = self._map_samples( file )[ file[ "leader_length" ]: ]
+            offset  = file[ "offset" ]
+            breaks  = [ [0, offset] ]
+
+            for first in range( 0, nframes, window ):
+                last = min( nframes, first + window )
+                r = ref_samples[ first:last ]
+                t = self._slice_frames( samples, first + offset, last + offset )
+                # the end of the window has to match too, or a slip late in the window would pass
+                # on the frames before it, and be missed altogether in the last window
+                equal = ( r == t )
+                if ( np.count_nonzero( equal ) >= DRIFT_MATCH * r.size and
+                     np.count_nonzero( equal[ -probe: ] ) >= DRIFT_MATCH * equal[ -probe: ].size ):
+                    continue
+
+                # lost sync in this window, look for the offset that matches its end
+                new = self._search_offset( ref_samples, samples, max( first, last - probe ), last, offset, max_slip )
+                if new is None or new == offset: # just a noisy stretch, not a slip
+                    continue
+
+                # the slip is where the old offset stops matching and the new one starts, the split
+                # point with the most matching frames on both sides. The previous window can hold it
+                # too, it still passed if less than half of it came after the slip
+                lo = max( breaks[-1][0], first - window )
+                r  = ref_samples[ lo:last ]
+                eq_old = ( r == self._slice_frames( samples, lo + offset, last + offset ) ).all( axis=1 )
+                eq_new = ( r == self._slice_frames( samples, lo + new, last + new ) ).all( axis=1 )
+                matched = ( np.concatenate( ( [0], np.cumsum( eq_old ) ) ) +
+                            np.concatenate( ( np.cumsum( eq_new[::-1] )[::-1], [0] ) ) )
+                split = lo + int( np.argmax( matched ) )
+
+                if split == breaks[-1][0]: # the previous offset never applied
+                    breaks[-1][1] = new
+                else:
+                    breaks.append( [split, new] )
+                offset = new
+                print( "drift: {0:s} at {1:s} offset:{2:+d}".format(
+                    file[ "name" ], self.sample_to_time( split ), new ))
+
+            file[ "offset_map" ] = np.array( breaks, dtype=np.int64 )
+
+        self._stage_done( "drift", t0, nframes * len( file_list ),
+                          nframes * len( file_list ) * ref[ "nchannels" ] * ref[ "sampwidth" ] )
+    # END DAT_Fix.map_drift()
+
+    def _search_offset( self, ref_samples, samples, first, last, offset, max_slip ):
+        """
+        " internal function used by DAT_Fix.map_drift()
+        "
+        " find the offset within max_slip of offset at which samples matches
+        " ref_samples[ first:last ]
+        "
+        " outputs:
+        "   the offset, or None if no offset matches well enough
+        """
+        a = ref_samples[ first:last ].astype( np.float32 ).sum( axis=1 )
+        lo = max( 0, first + offset - max_slip )
+        b = samples[ lo : last + offset + max_slip ].astype( np.float32 ).sum( axis=1 )
+        lag = self._best_lag( a, b )
+        if lag is None:
+            return None
+
+        new = lo + lag - first
+        t = self._slice_frames( samples, first + new, last + new )
+        if np.count_nonzero( ref_samples[ first:last ] == t ) < DRIFT_MATCH * t.size:
+            return None
+        return new
+    # END DAT_Fix._search_offset()
+
+    def _slice_frames( self, samples, first, last ):
+        """
+        " frames first to last of samples, frames outside the file are zero
+        " a view when the range is within the file, otherwise a copy
+        """
+        if first >= 0 and last <= len( samples ):
+            return samples[ first:last ]
+        out = np.zeros( ( last - first, samples.shape[1] ), dtype=samples.dtype )
+        lo = min( max( first, 0 ), len( samples ) )
+        hi = max( min( last, len( samples ) ), lo )
+        out[ lo - first : hi - first ] = samples[ lo:hi ]
+        return out
+    # END DAT_Fix._slice_frames()
+
+    def _offset_map( self, file ):
+        """
+        " (frame, offset) breakpoints of a take, from map_drift(), or
+        " just the offset from align_takes() if the drift wasn't mapped
+        """
+        if "offset_map" in file:
+            return file[ "offset_map" ]
+        return np.array( [ [0, file.get( "offset", 0 )] ], dtype=np.int64 )
+    # END DAT_Fix._offset_map()
+
+    def _read_mapped( self, file, samples, first, last ):
+        """
+        " read frames first to last of the program from a take, following its offset map
+        "
+        " inputs:
+        "   file{}  - file info dictionary
+        "   samples - the mapped samples of the whole take, from _map_samples()
+        "   first, last - frame range, counted from the start of the reference program
+        "
+        " outputs:
+        "   int16 array of the frames, a view into the file when the range doesn't cross a
+        "   breakpoint. Frames outside the take are zero
+        """
+        breaks = self._offset_map( file )
+        lead   = file[ "leader_length" ]
+
+        i = np.searchsorted( breaks[:, 0], first, side="right" ) - 1
+        j = np.searchsorted( breaks[:, 0], last - 1, side="right" ) - 1
+        if i >= j:
+            offset = lead + breaks[ max( i, 0 ), 1 ]
+            return self._slice_frames( samples, first + offset, last + offset )
+
+        out = np.empty( ( last - first, samples.shape[1] ), dtype=samples.dtype )
+        for k in range( i, j + 1 ):
+            seg_first = max( first, breaks[k, 0] )
+            seg_last  = min( last, breaks[k + 1, 0] ) if k + 1 < len( breaks ) else last
+            offset = lead + breaks[k, 1]
+            out[ seg_first - first : seg_last - first ] = self._slice_frames(
+                samples, seg_first + offset, seg_last + offset )
+        return out
+    # END DAT_Fix._read_mapped()
+
+    def _program_start( self, file ):
+        """
+        " first frame of a take lined up with the other takes: after its leader,
+        " and shifted by the offset found by align_takes(), if it was used
+        """
+        return file[ "leader_length" ] + file.get( "offset", 0 )
+    # END DAT_Fix._program_start()
+
+    def _program_length( self, file ):
+        """
+        " internal function used by the functions that combine takes
+        " number of frames of a take from its program start up to its trailer
+        """
+        return file[ "nframes" ] - file.get( "trailer_length", 0 ) - self._program_start( file )
+    # END DAT_Fix._program_length()
+
+    def _read_ahead( self, file_list, start, stop, block_frames, skip=None ):
+        """
+        " internal function used by DAT_Fix.iter_takes()
+        "
+        " each take is read by its own background thread up to PREFETCH_DEPTH blocks
+        " ahead, so reading overlaps with the work on the current block, and takes on
+        " different drives are read at the same time. The blocks are copies rather
+        " than views, so the pages are read on the background thread. The threads of
+        " the takes after the first pass None for the blocks skip() says aren't needed
+        """
+        frames = range( start, stop, block_frames )
+        queues = [ queue.Queue( maxsize=PREFETCH_DEPTH ) for file in file_list ]
+        done = threading.Event()
+
+        def put( q, item ):
+            # gives up once the consumer has stopped, rather than waiting on a full queue
+            while not done.is_set():
+                try:
+                    q.put( item, timeout=0.1 )
+                    return
+                except queue.Full:
+                    pass
+
+        def reader( file, q, first_take ):
+            try:
+                samples = self._map_samples( file )
+                for frame in frames:
+                    if done.is_set():
+                        return
+                    last = min( stop, frame + block_frames )
+                    if not first_take and skip is not None and skip( frame, last ):
+                        put( q, None )
+                    else:
+                        put( q, np.array( self._read_mapped( file, samples, frame, last ) ) )
+            except BaseException as e:
+                put( q, e )
+
+        threads = [ threading.Thread( target=reader, args=( file, q, i == 0 ), daemon=True )
+                    for (i, (file, q)) in enumerate( zip( file_list, queues ) ) ]
+        for t in threads:
+            t.start()
+
+        try:
+            for frame in frames:
+                blocks = [ q.get() for q in queues ]
+                for block in blocks:
+                    if isinstance( block, BaseException ):
+                        raise block
+                yield ( frame, blocks )
+        finally:
+            done.set()
+    # END DAT_Fix._read_ahead()
+
+    def _start_writer( self, wav_out ):
+        """
+        " internal function used by the functions that combine takes
+        "
+        " start a background thread writing blocks of frames to wav_out, so writing
+        " overlaps with the work on the next chunk. Blocks are queued with
+        " writer[ "queue" ].put(), up to PREFETCH_DEPTH of them, see _finish_writer()
+        """
+        writer = { "queue":queue.Queue( maxsize=PREFETCH_DEPTH ), "error":None }
+
+        def write():
+            while True:
+                block = writer[ "queue" ].get()
+                if block is None:
+                    return
+                if writer[ "error" ] is None:
+                    try:
+                        wav_out.writeframesraw( block.astype( "<i2" ).tobytes() )
+                    except BaseException as e:
+                        writer[ "error" ] = e
+
+        writer[ "thread" ] = threading.Thread( target=write, daemon=True )
+        writer[ "thread" ].start()
+        return writer
+    # END DAT_Fix._start_writer()
+
+    def _finish_writer( self, writer, wav_out ):
+        """
+        " internal function used by the functions that combine takes
+        " wait for the writer thread to write everything queued, close wav_out, and pass on
+        " any error. Called from a finally clause, so the thread and the file are cleaned up
+        " when the work fails too
+        """
+        writer[ "queue" ].put( None )
+        writer[ "thread" ].join()
+        wav_out.close()
+        if writer[ "error" ] is not None:
+            raise writer[ "error" ]
+    # END DAT_Fix._finish_writer()
 
-        wav_master = wave.open ( filename_master, "r")
-        wav_donor  = wave.open ( filename_donor, "r")
+    def _vote( self, takes ):
+        """
+        " internal function used by DAT_Fix.consensus()
+        "
+        " consensus of a stack of aligned blocks, staying in int16 throughout
+        "   3 and 5 takes: median by a min/max network, no sorting
+        "   other odd counts: median by partial sort
+        "   even counts: the value more takes have than any other, otherwise the first take
+        " for 3 takes the median is also the majority whenever two takes agree
+        "
+        " inputs:
+        "   takes - numpy array (ntakes, frames, nchannels) of samples
+        "
+        " outputs:
+        "   numpy array (frames, nchannels) of samples
+        """
+        ntakes = len( takes )
+        mn = np.minimum
+        mx = np.maximum
+
+        if ntakes == 1:
+            return takes[0].copy()
+        if ntakes == 3:
+            (a, b, c) = takes
+            return mx( mn( a, b ), mn( mx( a, b ), c ) )
+        if ntakes == 5:
+            (a, b, c, d, e) = takes
+            f = mx( mn( a, b ), mn( c, d ) )
+            g = mn( mx( a, b ), mx( c, d ) )
+            return mx( mn( e, f ), mn( mx( e, f ), g ) )
+
+        mid = ntakes // 2
+        if ntakes % 2:
+            return np.partition( takes, mid, axis=0 )[mid]
+
+        # even counts have no median sample, the value most takes agree on wins
+        counts = np.zeros( takes.shape, dtype=np.uint8 )
+        for other in takes:
+            counts += ( takes == other )
+        most   = counts.max( axis=0 )
+        winner = np.take_along_axis( takes, counts.argmax( axis=0 )[ np.newaxis ], axis=0 )[0]
+        tied   = ( ( counts == most ) & ( takes != winner ) ).any( axis=0 )
+        return np.where( tied, takes[0], winner )
+    # END DAT_Fix._vote()
+
+    def consensus( self, file_list, out_name="out.wav" ):
+        """
+        " combine any number of aligned takes sample by sample,
+        " see _vote() for how each sample is chosen
+        "
+        " inputs:
+        "   file_list: list of file info dicts, after analyze() and align_takes()
+        "              the first take decides ties when the count is even
+        "   out_name:  optional - file to write
+        "
+        " outputs:
+        "   out_name:  merged file
+        "   file[ "outvoted" ] - numpy array, for each block the number of samples
+        "                        of this take that differ from the output
+        """
+        t0 = self._stage_start()
+        master    = file_list[0]
+        nchannels = master[ "nchannels" ]
+        sampwidth = master[ "sampwidth" ]
+        framerate = master[ "framerate" ]
 
+        self.framerate = framerate
 
         # ceil( nframes / CHUNK)
         # thanks to https://stackoverflow.com/questions/14822184/is-there-a-ceiling-equivalent-of-operator-in-python
         # ceil ( a /b ) == -( -a // b)
-        nframes = min( (nframes_master - lead_frames_master), (nframes_master - lead_frames_master) )
-
+        nframes = min( self._program_length( file ) for file in file_list )
         num_chunks = -( -nframes // CHUNK )
-        
-        nchannels = 2
+
+        outvoted = np.zeros( ( len( file_list ), num_chunks ), dtype=np.int64 )
 
         # prepare the output file
-        wav_out = wave.open( "out.wav", 'wb' )
+        wav_out = wave.open( out_name, 'wb' )
         wav_out.setnchannels( nchannels )
         wav_out.setsampwidth( sampwidth )
         wav_out.setframerate( framerate )
-        #wav_out.setnframes( nframes )
-        
-        # fast forward through lead_frames
-        wav_master.readframes ( lead_frames_master )
-        wav_donor.readframes (  lead_frames_donor )
+        wav_out.setnframes( nframes )
+        writer = self._start_writer( wav_out )
+        try:
+            # blocks that are the same in every take are copied from the first take without a vote,
+            # and the other takes are only read where they differ
+            skip = self._skip_same( self._same_blocks( file_list, nframes ) )
+            skipped = 0
+
+            # the next chunk of each take after the lead_frames, following any drift, read ahead
+            for (chunk_num, (first, blocks)) in enumerate( self.iter_takes( file_list, 0, nframes, skip=skip ) ):
+                last = first + len( blocks[0] )
+                if blocks[-1] is None:
+                    out = blocks[0]
+                    skipped += 1
+                else:
+                    takes = np.stack( blocks )
+                    out = self._vote( takes )
+                    outvoted[:, chunk_num] = ( takes != out ).reshape( len( file_list ), -1 ).sum( axis=1 )
 
-        # pre-scan initialization
-        frame_num = 0
-        prev_l = 0
-        dropout_len_l = 0
-        master_l_data = []
-        donor_l_data = []
-        out_l_data = []
-        
-        prev_r = 0
-        dropout_len_r = 0
-        donor_r_data = []
-        master_r_data = []
-        out_r_data = []
-
-        # scan file for differences
-        for chunk_num in range( num_chunks ):
-
-            # handle possibly odd sized last chunk
-            if frame_num + CHUNK > nframes:
-                chunk_size = nframes - chunk_num*CHUNK
+                writer[ "queue" ].put( out )
+
+                self._progress( "median", last, nframes, lambda: "C:{0:08d} F:{1:s} ({2:5.1f}%)".format(
+                    chunk_num, self.sample_to_time( last ), 100.0 * last / nframes ))
+        finally:
+            # close file, also when something fails, so the writer thread doesn't wait forever
+            self._finish_writer( writer, wav_out )
+
+        print()
+        print( "{0:d} of {1:d} chunks the same in every take".format( skipped, num_chunks ))
+
+        for (i, file) in enumerate( file_list ):
+            file[ "outvoted" ] = outvoted[i]
+            print( "{0:s}: outvoted on {1:d} samples".format( file[ "name" ], int( outvoted[i].sum() ) ) )
+        self._stage_done( "median", t0, nframes, nframes * len( file_list ) * nchannels * sampwidth )
+    # END DAT_Fix.consensus()
+
+    def scan_differences( self, file_list, window=DIFF_WINDOW, min_diff=DIFF_MIN ):
+        """
+        " find the noisy dropouts that the duplicate sample scan misses, by comparing aligned takes
+        "
+        " each sample of each take is compared with the consensus of all the takes, see _vote(),
+        " and the differences are counted over a sliding window with a cumulative sum, so the
+        " cost is the same for any window size. A take departs from the others where min_diff
+        " or more samples of a window differ. The takes are read once, a block at a time, with
+        " a couple of windows of differences carried from one block to the next
+        "
+        " inputs:
+        "   file_list: list of file info dicts, after analyze() and align_takes(), at least three
+        "   window, min_diff: optional - see DIFF_WINDOW and DIFF_MIN
+        "
+        " outputs:
+        "   file[ "differences" ] - DROPOUT_DTYPE array of the regions where each take departs from the
+        "                           others, in the take's own frames like file[ "dropouts" ], from the first
+        "                           to the last differing sample, with the first differing sample as value.
+        "                           plan_fill() fills these as well as the dropouts
+        "   returns the list of file[ "differences" ]
+        """
+        if len( file_list ) < 3:
+            print( "Need at least three takes to tell which one differs" )
+            raise ValueError
+        window = max( 2, window )
+
+        t0 = self._stage_start()
+        ntakes    = len( file_list )
+        nchannels = file_list[0][ "nchannels" ]
+        nframes   = min( self._program_length( file ) for file in file_list )
+        self.framerate = file_list[0][ "framerate" ]
+
+        # differences from frame done - pad on, the frames from done on aren't decided yet
+        pad  = window - 1
+        done = 0
+        carry = np.zeros( ( ntakes, pad, nchannels ), dtype=bool )
+        zero  = np.zeros( ( ntakes, 1, nchannels ), dtype=np.int32 )
+
+        closed = [ [] for file in file_list ]
+        opened = np.full( ( ntakes, nchannels, 2 ), -1, dtype=np.int64 )
+
+        blocks = self.iter_takes( file_list, 0, nframes )
+        while done < nframes:
+            (first, takes) = next( blocks, ( nframes, None ) )
+            if takes is None: # flush, nothing differs after the end
+                diff = np.zeros( ( ntakes, pad, nchannels ), dtype=bool )
+                end  = nframes + pad
             else:
-                chunk_size = CHUNK
-
-            # read the next chunk
-            chunk = wav_master.readframes ( chunk_size )
-            out = struct.unpack_from ( "%dh" % nchannels * chunk_size, chunk )
-
-            # Convert 2 channels to numpy arrays and analyze for drop-outs
-            left_master  = np.array (list ( out[0::2] ))
-            right_master = np.array (list ( out[1::2] ))
-
-            chunk = wav_donor.readframes ( chunk_size )
-            out = struct.unpack_from ( "%dh" % nchannels * chunk_size, chunk )
-            left_donor  = np.array (list ( out[0::2] ))
-            right_donor = np.array (list ( out[1::2] ))
-
-            # scan the left
-            # TODO: zip( left_master, left_donor, right_master, right_donor) ??
-            for i in range( len( left_master ) ):
-
-                if left_master[i] == prev_l:
-                    donor_l_data.append( left_donor[i] )
-                    master_l_data.append( left_master[i] )
-
-                else: # new sample, check if ending a dropout region
-
-                    dropout_len_l = len( master_l_data )
-                    if dropout_len_l > thresh: # end of new dropout
-                        # this is just a straight copy of the donor into the master
-                        # it is tempting to scan the donor for dropouts, but this
-                        # adds complexity, and since we know the master has a dropout
-                        # in this region, the donor can't be worse, and might even
-                        # be better. Copying is simpler, and at worst makes no change.
-                        out_l_data.extend( donor_l_data )
-                        master_l_data=[ left_master[i] ] 
-                        donor_l_data=[ left_donor[i] ]
-
-                    elif dropout_len_l > 0 : # end of duplicate region too short to be a dropout
-                        out_l_data.extend( master_l_data )
-                        master_l_data=[ left_master[i] ] 
-                        donor_l_data=[ left_donor[i] ]
-
-                    else: # no duplicates
-                        master_l_data=[ left_master[i] ] 
-                        donor_l_data=[ left_donor[i] ]
-
-                    # reset 
-                    prev_l = left_master[i]
-                    dropout_len_l = 0
-
-
-                # scan the right
-                if right_master[i] == prev_r:
-                    donor_r_data.append( right_donor[i] )
-                    master_r_data.append( right_master[i] )                 
-
-                else: # new sample, check if ending a dropout region
-
-                    dropout_len_r = len( master_r_data )
-                    if dropout_len_r > thresh: # end of new dropout
-                        out_r_data.extend( donor_r_data )
-                        master_r_data=[ right_master[i] ]
-                        donor_r_data=[ right_donor[i] ]
-
-                    elif dropout_len_r > 0 : # end of duplicate region too short to be a dropout
-                        out_r_data.extend( master_r_data )
-                        master_r_data=[ right_master[i] ]
-                        donor_r_data=[ right_donor[i] ]
-
-                    else: # no duplicates
-                        master_r_data=[ right_master[i] ]
-                        donor_r_data=[ right_donor[i] ]
-
-                    # reset 
-                    prev_r = right_master[i]
-                    dropout_len_r = 0
-
-                # flush merged data
-                write_len = min( len( out_l_data ), len( out_r_data ) )
-
-                #print( "C:{0:08d} F:{1:09d} M:({2: 06d},{3: 06d})\tD:({4: 06d},{5: 06d})\tL:{6: 06d},{7: 06d}\tout:{8: 06d}:{9: 06d}\twrite:{10: 06d}".format(
-                #    chunk_num, frame_num, 
-                #    left_master[i], right_master[i],
-                #    left_donor[i],  right_donor[i],
-                #    len(master_l_data), len(master_r_data), len( out_l_data), len( out_r_data), write_len ), end='\r', flush=True)
-                if write_len > 20:
-                    print( "C:{0:08d} F:{1:s} M:({2: 06d},{3: 06d})\tD:({4: 06d},{5: 06d})\tL:{6: 06d},{7: 06d}\tout:{8: 06d}:{9: 06d}\twrite:{10: 06d}".format(
-                        chunk_num, self.sample_to_time( frame_num + i ), 
-                        left_master[i], right_master[i],
-                        left_donor[i],  right_donor[i],
-                        len(master_l_data), len(master_r_data), len( out_l_data), len( out_r_data), write_len ) )
-
-                if write_len > 0:
-                    for (l, r) in zip( out_l_data[:write_len], out_r_data[:write_len] ):
-                        wav_out.writeframesraw( struct.pack('<hh', int(l), int(r) ) )
-
-                    out_l_data=out_l_data[write_len:]
-                    out_r_data=out_r_data[write_len:]
-
-            frame_num += chunk_size
-            print( "C:{0:08d} F:{1:s} ({2:5.1f}%)".format(
-                chunk_num, self.sample_to_time( frame_num ), 100.0 * frame_num / nframes ), end='\r', flush=True)
-
-        # TODO
-        # there may still be data in master_l_data / master_r_data - flush to file
-        #dropout_len_l = len( master_l_data )
-        #if dropout_len_l > thresh:
-        #    out_l_data.extend( donor_l_data )
-        #else:
-        #    out_l_data.extend( master_l_data )
-        #
-        #dropout_len_r = len( master_r_data )
-        #if dropout_len_r > thresh:
-        #    out_r_data.extend( donor_r_data )
-        #else:
-        #    out_r_data.extend( master_r_data )
-        #    
-        #write_len = min( len( out_l_data ), len( out_r_data ) )
-        #if write_len > 0:
-        #    for (l, r) in zip( out_l_data[:write_len], out_r_data[:write_len] ):
-        #        wav_out.writeframesraw( struct.pack('<hh', int(l), int(r) ) )
-
-        # close file
-        wav_master.close()
-        wav_donor.close()
-        wav_out.close()
+                takes = np.stack( takes )
+                diff  = takes != self._vote( takes )
+                end   = first + takes.shape[1]
+            diff = np.concatenate( ( carry, diff ), axis=1 )
+
+            # windows with enough differences, then the samples any of them cover
+            counts  = np.concatenate( ( zero, np.cumsum( diff, axis=1, dtype=np.int32 ) ), axis=1 )
+            flagged = counts[:, window:] - counts[:, :-window] >= min_diff
+            covered = np.concatenate( ( zero, np.cumsum( flagged, axis=1, dtype=np.int32 ) ), axis=1 )
+
+            count  = max( 0, end - pad - done )
+            region = ( covered[:, pad + 1 : pad + 1 + count] - covered[:, :count] > 0 ) & diff[:, pad : pad + count]
+
+            # differing samples less than a window apart are one region
+            for (t, c) in np.argwhere( region.any( axis=1 ) ):
+                p = np.flatnonzero( region[t, :, c] ) + done
+                cuts   = np.flatnonzero( np.diff( p ) > window )
+                starts = np.concatenate( ( p[:1], p[ cuts + 1 ] ) )
+                lasts  = np.concatenate( ( p[ cuts ], p[-1:] ) )
+                (start, last) = opened[t, c]
+                if start >= 0 and starts[0] - last <= window:
+                    starts[0] = start
+                elif start >= 0:
+                    closed[t].append( ( c, start, last ) )
+                closed[t].extend( ( c, a, b ) for (a, b) in zip( starts[:-1], lasts[:-1] ) )
+                opened[t, c] = ( starts[-1], lasts[-1] )
+
+            carry = diff[:, count:]
+            done += count
+
+            self._progress( "diff", done, nframes, lambda: "F:{0:s} ({1:5.1f}%)".format(
+                self.sample_to_time( done ), 100.0 * done / max( 1, nframes ) ))
+
+        if not self.quiet:
+            print()
+        for (t, file) in enumerate( file_list ):
+            for c in range( nchannels ):
+                if opened[t, c, 0] >= 0:
+                    closed[t].append( ( c, opened[t, c, 0], opened[t, c, 1] ) )
+
+            # program frames to the take's frames, following its offset map
+            found = np.array( sorted( closed[t], key=lambda r: ( r[1], r[0] ) ), dtype=np.int64 ).reshape( -1, 3 )
+            breaks = self._offset_map( file )
+            offset = breaks[ np.maximum( np.searchsorted( breaks[:, 0], found[:, 1], side="right" ) - 1, 0 ), 1 ]
+
+            differences = np.zeros( len( found ), dtype=DROPOUT_DTYPE )
+            differences[ "channel" ] = found[:, 0]
+            differences[ "start" ]   = found[:, 1] + file[ "leader_length" ] + offset
+            differences[ "length" ]  = found[:, 2] - found[:, 1] + 1
+            samples = self._map_samples( file )
+            differences[ "value" ]   = samples[ differences[ "start" ], differences[ "channel" ] ]
+            file[ "differences" ] = differences
+
+            print( "differences: {0:s} regions:{1:d} frames:{2:d}".format(
+                file[ "name" ], len( differences ), int( differences[ "length" ].sum() ) ))
+
+        self._stage_done( "diff", t0, nframes, nframes * ntakes * nchannels * file_list[0][ "sampwidth" ] )
+        return [ file[ "differences" ] for file in file_list ]
+    # END DAT_Fix.scan_differences()
+
+    def quality_timeline( self, file_list, seconds=TIMELINE_SECONDS ):
+        """
+        " score the takes window by window rather than with a single number, so that it can be
+        " seen which take is best in each part of the tape, see best_takes()
+        "
+        " the aligned takes are read once, a window at a time. The duplicates are counted as by
+        " dropout_score(), the longest runs come from the run tables of analyze(), and with three
+        " or more takes a sample differs when it isn't the consensus, see _vote(). With two takes
+        " the samples where they differ count against both
+        "
+        " inputs:
+        "   file_list: list of file info dicts, after analyze() and, for more than one take, align_takes()
+        "   seconds:   optional - length of a window
+        "
+        " outputs:
+        "   file[ "timeline" ] - TIMELINE_DTYPE array with an entry per window of the program,
+        "                        windows start at the same program frame in every take
+        """
+        t0 = self._stage_start()
+        master    = file_list[0]
+        ntakes    = len( file_list )
+        framerate = master[ "framerate" ]
+        self.framerate = framerate
+
+        window  = max( 1, int( round( seconds * framerate ) ) )
+        nframes = max( 0, min( self._program_length( file ) for file in file_list ) )
+        nwindows = -( -nframes // window )
+
+        timelines = [ np.zeros( nwindows, dtype=TIMELINE_DTYPE ) for file in file_list ]
+        for timeline in timelines:
+            timeline[ "start" ]  = np.arange( nwindows, dtype=np.int64 ) * window
+            timeline[ "length" ] = np.minimum( window, nframes - timeline[ "start" ] )
+
+        # the frame before the program, so the first sample is compared with something
+        samples = [ self._map_samples( file ) for file in file_list ]
+        prev = np.stack( [ self._read_mapped( file, samples[i], -1, 0 ) for (i, file) in enumerate( file_list ) ] )
+
+        for (k, (first, blocks)) in enumerate( self.iter_takes( file_list, 0, nframes, block_frames=window ) ):
+            takes = np.stack( blocks )
+            both  = np.concatenate( ( prev, takes ), axis=1 )
+            dups  = np.count_nonzero( both[:, 1:] == both[:, :-1], axis=( 1, 2 ) )
+            prev  = takes[:, -1:]
+
+            if ntakes >= 3:
+                differ = np.count_nonzero( takes != self._vote( takes ), axis=( 1, 2 ) )
+            elif ntakes == 2:
+                differ = np.full( 2, np.count_nonzero( takes[0] != takes[1] ) )
+            else:
+                differ = np.zeros( 1, dtype=np.int64 )
+
+            for (i, timeline) in enumerate( timelines ):
+                timeline[ "dups" ][k]   = dups[i]
+                timeline[ "differ" ][k] = differ[i]
+
+            last = first + takes.shape[1]
+            self._progress( "timeline", last, nframes, lambda: "F:{0:s} ({1:5.1f}%)".format(
+                self.sample_to_time( last ), 100.0 * last / max( 1, nframes ) ))
+
+        if not self.quiet:
+            print()
+
+        # longest runs, the run table trimmed to the program as for the dropouts
+        for (file, timeline) in zip( file_list, timelines ):
+            if nwindows == 0 or "runs" not in file:
+                continue
+            runs  = file[ "runs" ]
+            start = self._program_start( file )
+            firsts = np.maximum( runs[ "start" ], file[ "leader_length" ] ) - start
+            lasts  = np.minimum( runs[ "start" ] + runs[ "length" ], file[ "nframes" ] - file[ "trailer_length" ] ) - start
+            keep   = ( lasts > firsts ) & ( lasts > 0 ) & ( firsts < nframes )
+            (firsts, lasts) = ( np.maximum( firsts[ keep ], 0 ), np.minimum( lasts[ keep ], nframes ) )
+            lengths = ( lasts - firsts ).astype( np.int64 )
+
+            k0 = firsts // window
+            k1 = ( lasts - 1 ) // window
+            np.maximum.at( timeline[ "longest" ], k0, lengths )
+            for i in np.flatnonzero( k1 > k0 ): # runs reaching into later windows
+                timeline[ "longest" ][ k0[i] + 1 : k1[i] + 1 ] = np.maximum(
+                    timeline[ "longest" ][ k0[i] + 1 : k1[i] + 1 ], lengths[i] )
+
+        for (file, timeline) in zip( file_list, timelines ):
+            file[ "timeline" ] = timeline
+        self._stage_done( "timeline", t0, nframes, nframes * ntakes * master[ "nchannels" ] * master[ "sampwidth" ] )
+    # END DAT_Fix.quality_timeline()
+
+    def timeline_query( self, file, start=None, stop=None ):
+        """
+        " the windows of a take's timeline overlapping a time range
+        "
+        " inputs:
+        "   file{}      - file info dictionary, after quality_timeline()
+        "   start, stop - optional - range in seconds from the start of the program, by default all of it
+        "
+        " outputs:
+        "   TIMELINE_DTYPE array, a view into file[ "timeline" ]
+        """
+        timeline = file[ "timeline" ]
+        first = 0 if start is None else max( 0, np.searchsorted( timeline[ "start" ], start * file[ "framerate" ], side="right" ) - 1 )
+        last  = len( timeline ) if stop is None else np.searchsorted( timeline[ "start" ], stop * file[ "framerate" ], side="left" )
+        return timeline[ first:last ]
+    # END DAT_Fix.timeline_query()
+
+    def best_takes( self, file_list, start=None, stop=None ):
+        """
+        " which take is best in each window of a time range, from the timelines
+        "
+        " takes are compared by the samples that differ from the other takes, then by the longest
+        " run, then by the duplicates, the first take winning ties
+        "
+        " inputs:
+        "   file_list   - list of file info dicts, after quality_timeline()
+        "   start, stop - optional - range in seconds from the start of the program
+        "
+        " outputs:
+        "   (starts, best) - numpy arrays, the program frame of each window and the index
+        "                    into file_list of the best take for it
+        """
+        windows = [ self.timeline_query( file, start, stop ) for file in file_list ]
+        differ  = np.stack( [ w[ "differ" ] for w in windows ] )
+        longest = np.stack( [ w[ "longest" ] for w in windows ] )
+        dups    = np.stack( [ w[ "dups" ] for w in windows ] )
+
+        # lexsort sorts by the last key first, and keeps the order of the takes for ties
+        order = np.lexsort( ( dups, longest, differ ), axis=0 )
+        return ( windows[0][ "start" ], order[0] )
+    # END DAT_Fix.best_takes()
+
+    def print_best_takes( self, file_list, start=None, stop=None ):
+        """
+        " print the stretches of the tape where each take is best, see best_takes()
+        """
+        (starts, best) = self.best_takes( file_list, start, stop )
+        windows = self.timeline_query( file_list[0], start, stop )
+        self.framerate = file_list[0][ "framerate" ]
+
+        # stretches of windows with the same best take
+        changes = np.flatnonzero( np.diff( best ) ) + 1
+        for (first, last) in zip( np.concatenate( ( [0], changes ) ), np.concatenate( ( changes, [ len( best ) ] ) ) ):
+            if last > first:
+                print( "best: {0:s} to {1:s} {2:s}".format( self.sample_to_time( int( starts[ first ] ) ),
+                       self.sample_to_time( int( windows[ "start" ][ last - 1 ] + windows[ "length" ][ last - 1 ] ) ),
+                       file_list[ best[ first ] ][ "name" ] ))
+    # END DAT_Fix.print_best_takes()
+
+    def median_3( self, file_list, out_name="out.wav" ):
+        """
+        " take three copies of a file
+        " and use a median filter to eliminate dropouts where possible
+        "
+        " Note: this is fairly fast and shows some improvement, 
+        " but can sometimes propagate errors
+        """
+        self.consensus( file_list[:3], out_name )
+    # END DAT_Fix.median_3()
+
+
+    def _fill_chunk( self, master, donor, states, base, frame_num, thresh, flush=False ):
+        """
+        " internal function used by DAT_Fix.do_scan_and_fill_2()
+        "
+        " find the runs of duplicated samples completed in each channel of a chunk of the master.
+        " Runs longer than thresh samples are dropouts, and are replaced with the donor
+        " samples from the same frames. This is just a straight copy of the donor into the master.
+        " It is tempting to scan the donor for dropouts, but this adds complexity, and since
+        " we know the master has a dropout in this region, the donor can't be worse, and might even
+        " be better. Copying is simpler, and at worst makes no change.
+        "
+        " inputs:
+        "   master, donor - numpy arrays of frames from each file, the frames held back
+        "                   by the previous chunk followed by the new chunk
+        "   states[]  - run state of each master channel, see _find_runs()
+        "   base      - frame number of master[0]
+        "   frame_num - frame number of the first frame of the new chunk
+        "   thresh    - dropout threshold
+        "   flush     - end of the file, close the open runs and return everything
+        "
+        " outputs:
+        "   (out, master, donor) - merged frames ready to be written, and the frames held
+        "                          back until the runs still open are known to be dropouts
+        "                          or not, at most thresh frames
+        """
+        out = master.copy()
+        done = len( out )
+
+        for (c, state) in enumerate( states ):
+            (starts, lengths, values) = self._find_runs( master[frame_num - base:, c], state, frame_num )
+            if flush and state["length"] > 0:
+                starts  = np.append( starts,  state["start"] )
+                lengths = np.append( lengths, state["length"] )
+
+            for i in np.flatnonzero( lengths > thresh ):
+                # the part of the run before base was filled when it was written
+                first = max( starts[i] - base, 0 )
+                out[first:starts[i] + lengths[i] - base, c] = donor[first:starts[i] + lengths[i] - base, c]
+                print( "\n{0:s} fill {1:s} Dur {2:s}".format(
+                    state["channel"], self.sample_to_time( starts[i] ), self.sample_to_time( lengths[i] ) ) )
+
+            if flush:
+                continue
+            if state["length"] > thresh:
+                # the open run is already a dropout, fill as much of it as there is and let it go,
+                # so a long constant stretch isn't held back until it ends
+                first = max( state["start"] - base, 0 )
+                out[first:, c] = donor[first:, c]
+            else:
+                # everything before an open run that might still be a dropout is complete
+                done = min( done, state["start"] - base )
+
+        # frames held back keep any fills already made in them
+        return ( out[:done], out[done:], donor[done:] )
+    # END DAT_Fix._fill_chunk()
+
+    def do_scan_and_fill_2( self, file_list, thresh=100, out_name="out.wav" ):
+        """
+        " look for dropouts in file 1 where sample values are duplicated 
+        " for more than thresh samples, and then attempt to fill them from
+        " another file if there duplicate sample run length is less.
+        "
+        " This should work well for dropouts where the level is held constant
+        " and successive takes yield shorter dropouts or dropouts in different areas.
+        "
+        " this will not work for noisy dropouts where the value changes rapidly.
+        "
+        " inputs:
+        "    file_list: list of file info dicts provided by get_file_info() function
+        "               the master and one donor, see do_scan_and_fill() for more donors
+        "    thresh:    optional - specify threshold dropout size to fill
+        "    out_name:  optional - file to write
+        "
+        " outputs:
+        "    out_name:  merged file
+        """
+        t0 = self._stage_start()
+        # local copies of file parameters
+        nchannels = file_list[0][ "nchannels" ]
+        sampwidth = file_list[0][ "sampwidth" ]
+        framerate = file_list[0][ "framerate" ]
+
+        print("dropout threshold: "+str(thresh))
+                   
+        self.framerate = framerate
+
+        # frames the two takes have in common
+        nframes = min( self._program_length( file_list[0] ), self._program_length( file_list[1] ) )
+
+        # prepare the output file
+        wav_out = wave.open( out_name, 'wb' )
+        wav_out.setnchannels( nchannels )
+        wav_out.setsampwidth( sampwidth )
+        wav_out.setframerate( framerate )
+        wav_out.setnframes( nframes )
+        writer = self._start_writer( wav_out )
+        try:
+            # pre-scan initialization
+            states = [ { "prev":0, "start":0, "length":0, "dups":0,
+                         "channel":"LR"[c] if nchannels == 2 else str(c) } for c in range( nchannels ) ]
+
+            # frames from the start of the earliest open run no longer than thresh, held back
+            # until it is known whether the run is a dropout or not
+            base = 0
+            held_master = np.empty( ( 0, nchannels ), dtype=np.int16 )
+            held_donor  = np.empty( ( 0, nchannels ), dtype=np.int16 )
+
+            # where the digests of the two takes match, filling from the donor changes nothing,
+            # so it is only read where they differ
+            skip = self._skip_same( self._same_blocks( file_list[:2], nframes ) )
+
+            # scan file for differences, the next chunk of both takes after the lead_frames,
+            # following any drift, is read ahead
+            for (chunk_num, (frame_num, (master, donor))) in enumerate( self.iter_takes( file_list[:2], 0, nframes, skip=skip ) ):
+                last = frame_num + len( master )
+                if donor is None:
+                    donor = master
+
+                master = np.concatenate( ( held_master, master ) )
+                donor  = np.concatenate( ( held_donor,  donor ) )
+
+                # fill the dropouts completed in this chunk, on the last chunk close the open runs too
+                (out, held_master, held_donor) = self._fill_chunk(
+                    master, donor, states, base, frame_num, thresh, flush=( last == nframes ) )
+
+                # one interleaved block per chunk
+                writer[ "queue" ].put( out )
+                base += len( out )
+
+                self._progress( "fill", last, nframes, lambda: "C:{0:08d} F:{1:s} ({2:5.1f}%)".format(
+                    chunk_num, self.sample_to_time( last ), 100.0 * last / nframes ))
+        finally:
+            # close file, also when something fails, so the writer thread doesn't wait forever
+            self._finish_writer( writer, wav_out )
+
+        self._stage_done( "fill", t0, nframes, 2 * nframes * nchannels * sampwidth )
     # END DAT_Fix.do_scan_and_fill_2()
 
-if len(sys.argv) > 1:
+    def plan_fill( self, file_list, thresh=100 ):
+        """
+        " choose where each dropout in the first take (the master) is filled from
+        "
+        " for each dropout region in the master, the run tables of the other takes (donors)
+        " are checked for dropouts over the same frames. Regions found by scan_differences()
+        " count as dropouts too, and so do frames of the region in a donor's leader or trailer,
+        " or outside the donor altogether. The first donor with no dropout there is chosen,
+        " otherwise the donor with the fewest dropout samples in the region, and between donors
+        " with as many, the one with the fewest samples scan_differences() found. The region is
+        " cut down to the frames that donor has. A region where no donor does better than the
+        " master, like a long run that is in every take, is left to the master, with donor 0, and
+        " so is a region that is only a difference, with no held run, unless a donor is clean over
+        " most of it - the differences of the master there may be the other takes'. Lookups
+        " are binary searches of the sorted run tables, so no audio is read, and the cost of
+        " each region doesn't depend on the length of the takes.
+        "
+        " inputs:
+        "   file_list: list of file info dicts, after analyze() and align_takes()
+        "              the first is the master, any number of donors follow
+        "   thresh:    optional - specify threshold dropout size to fill
+        "
+        " outputs:
+        "   FILL_DTYPE array of the regions to fill, in frame order. The donor is an index
+        "   into file_list
+        """
+        master = file_list[0]
+        for file in file_list:
+            if "runs" not in file:
+                self._analyze( file, thresh )
+            elif file.get( "thresh" ) != thresh or "dropouts" not in file:
+                self._select_dropouts( file, thresh ) # the run table usually covers thresh already
+
+        # donor dropouts of each channel, sorted by frame, and the differences on their own
+        # to choose between donors with as many dropouts
+        donors = []
+        for file in file_list[1:]:
+            dropouts = self._fill_regions( file )
+            differences = file.get( "differences", np.zeros( 0, dtype=DROPOUT_DTYPE ) )
+            channels = []
+            for c in range( master[ "nchannels" ] ):
+                d = dropouts[ dropouts[ "channel" ] == c ]
+                n = differences[ differences[ "channel" ] == c ]
+                channels.append( ( d[ "start" ], d[ "start" ] + d[ "length" ], n[ "start" ], n[ "start" ] + n[ "length" ] ) )
+            donors.append( channels )
+
+        # master dropouts in program frames, the ones cut short by the start of the program must still be long enough
+        dropouts = self._fill_regions( master )
+        start  = self._program_start( master )
+        firsts = np.maximum( dropouts[ "start" ], start ) - start
+        lasts  = dropouts[ "start" ] + dropouts[ "length" ] - start
+        keep   = ( lasts - firsts > thresh ) | ( ( dropouts[ "start" ] >= start ) & ( lasts > firsts ) )
+        dropouts, firsts, lasts = dropouts[ keep ], firsts[ keep ], lasts[ keep ]
+
+        # regions with no held dropout in them are only differences, the master may be the right take there
+        held = master[ "dropouts" ]
+        held = [ ( held[ "start" ][ held[ "channel" ] == c ], ( held[ "start" ] + held[ "length" ] )[ held[ "channel" ] == c ] )
+                 for c in range( master[ "nchannels" ] ) ]
+
+        plan = np.zeros( len( dropouts ), dtype=FILL_DTYPE )
+        plan[ "channel" ] = dropouts[ "channel" ]
+        plan[ "start" ]   = firsts
+        plan[ "length" ]  = lasts - firsts
+
+        for i in range( len( plan ) ):
+            c = dropouts[ "channel" ][i]
+            best = None
+            unsure = self._overlap( held[c][0], held[c][1], firsts[i] + start, lasts[i] + start ) == 0
+            for d in range( len( donors ) ):
+                # the region in the donor's frames
+                donor  = file_list[ d + 1 ]
+                breaks = self._offset_map( donor )
+                lead   = donor[ "leader_length" ]
+                first  = lead + firsts[i] + breaks[ np.searchsorted( breaks[:, 0], firsts[i], side="right" ) - 1, 1 ]
+                last   = lead + lasts[i]  + breaks[ np.searchsorted( breaks[:, 0], lasts[i] - 1, side="right" ) - 1, 1 ]
+
+                # the donor's leader and trailer, and frames it doesn't have, are no better than dropouts
+                usable_first = min( max( first, lead ), last )
+                usable_last  = max( min( last, donor[ "nframes" ] - donor.get( "trailer_length", 0 ) ), usable_first )
+                outside = ( last - first ) - ( usable_last - usable_first )
+
+                (starts, ends, diff_starts, diff_ends) = donors[d][c]
+                overlap = outside + self._overlap( starts, ends, usable_first, usable_last )
+                noisy   = self._overlap( diff_starts, diff_ends, usable_first, usable_last )
+
+                # a donor with no more good frames than the master isn't used
+                good = ( last - first ) // 2 if unsure else last - first
+                if overlap < good and ( best is None or ( overlap, noisy ) < best[1:3] ):
+                    # only the frames the donor has are filled from it
+                    best = ( d + 1, overlap, noisy, firsts[i] + usable_first - first, lasts[i] - ( last - usable_last ) )
+                    if overlap == 0 and noisy == 0:
+                        break
+
+            if best is None:
+                plan[ "overlap" ][i] = plan[ "length" ][i]
+            else:
+                ( plan[ "donor" ][i], plan[ "overlap" ][i], plan[ "start" ][i], plan[ "length" ][i] ) = (
+                    best[0], best[1], best[3], best[4] - best[3] )
+
+        # cutting regions down can change their order
+        return plan[ np.lexsort( ( plan[ "channel" ], plan[ "start" ] ) ) ]
+    # END DAT_Fix.plan_fill()
+
+    def _overlap( self, starts, ends, first, last ):
+        """
+        " internal function used by DAT_Fix.plan_fill()
+        " number of frames from first to last inside the regions of a channel, given by their
+        " starts and ends - the regions don't overlap each other, so both ends are sorted
+        """
+        lo = np.searchsorted( ends, first, side="right" )
+        hi = np.searchsorted( starts, last, side="left" )
+        return int( ( np.minimum( ends[lo:hi], last ) - np.maximum( starts[lo:hi], first ) ).clip( 0 ).sum() )
+    # END DAT_Fix._overlap()
+
+    def _fill_regions( self, file ):
+        """
+        " internal function used by DAT_Fix.plan_fill()
+        "
+        " the dropouts of a take, together with the regions scan_differences() found in it,
+        " overlapping regions of a channel merged into one, in frame order
+        """
+        if len( file.get( "differences", () ) ) == 0:
+            return file[ "dropouts" ]
+
+        regions = np.concatenate( ( file[ "dropouts" ], file[ "differences" ] ) )
+        regions = regions[ np.lexsort( ( regions[ "start" ], regions[ "channel" ] ) ) ]
+        ends = regions[ "start" ] + regions[ "length" ]
+
+        # a region starts a new group unless it starts before an earlier one of the channel ends
+        reach = np.empty_like( ends )
+        for c in np.unique( regions[ "channel" ] ):
+            mine = regions[ "channel" ] == c
+            reach[ mine ] = np.maximum.accumulate( ends[ mine ] )
+        new = np.ones( len( regions ), dtype=bool )
+        new[1:] = ( regions[ "start" ][1:] >= reach[:-1] ) | ( regions[ "channel" ][1:] != regions[ "channel" ][:-1] )
+
+        groups = np.flatnonzero( new )
+        merged = regions[ groups ]
+        merged[ "length" ] = np.maximum.reduceat( ends, groups ) - merged[ "start" ]
+        return merged[ np.lexsort( ( merged[ "channel" ], merged[ "start" ] ) ) ]
+    # END DAT_Fix._fill_regions()
+
+    def do_scan_and_fill( self, file_list, thresh=100, out_name="out.wav" ):
+        """
+        " fill the dropouts in the first take (the master) from any number of other takes
+        "
+        " each dropout region is filled from the best donor for it, see plan_fill(),
+        " all other frames are copied from the master. Only the master, and the donors
+        " in the dropout regions, are read
+        "
+        " inputs:
+        "    file_list: list of file info dicts, after analyze() and align_takes()
+        "               the first is the master, followed by one or more donors
+        "    thresh:    optional - specify threshold dropout size to fill
+        "    out_name:  optional - file to write
+        "
+        " outputs:
+        "    out_name:  merged file
+        """
+        t0 = self._stage_start()
+        if len( file_list ) < 2:
+            print( "Need at least two takes to fill from" )
+            raise ValueError
+
+        master    = file_list[0]
+        nchannels = master[ "nchannels" ]
+        sampwidth = master[ "sampwidth" ]
+        framerate = master[ "framerate" ]
+
+        print("dropout threshold: "+str(thresh))
+
+        self.framerate = framerate
+
+        plan = self.plan_fill( file_list, thresh )
+        for d in range( 1, len( file_list ) ):
+            mine = plan[ plan[ "donor" ] == d ]
+            print( "fill from {0:s}: regions:{1:d} frames:{2:d} still dropouts:{3:d}".format(
+                file_list[d][ "name" ], len( mine ), int( mine[ "length" ].sum() ), int( mine[ "overlap" ].sum() ) ))
+
+        samples = [ self._map_samples( file ) for file in file_list ]
+
+        # frames all the takes have in common
+        nframes = min( self._program_length( file ) for file in file_list )
+
+        # prepare the output file
+        wav_out = wave.open( out_name, 'wb' )
+        wav_out.setnchannels( nchannels )
+        wav_out.setsampwidth( sampwidth )
+        wav_out.setframerate( framerate )
+        wav_out.setnframes( nframes )
+        writer = self._start_writer( wav_out )
+        try:
+            ends   = plan[ "start" ] + plan[ "length" ]
+            next   = 0  # next region of the plan to start
+            active = [] # regions overlapping the current chunk
+
+            # the master is read ahead, the donors only where they are needed
+            for (chunk_num, (first, (out,))) in enumerate( self.iter_takes( [ master ], 0, nframes ) ):
+                last = first + len( out )
+
+                # replace the regions overlapping this chunk with their donor
+                while next < len( plan ) and plan[ "start" ][ next ] < last:
+                    active.append( next )
+                    next += 1
+                active = [ i for i in active if ends[i] > first ]
+                for i in active:
+                    c = plan[ "channel" ][i]
+                    d = plan[ "donor" ][i]
+                    a = max( first, plan[ "start" ][i] )
+                    b = min( last, ends[i] )
+                    out[ a - first : b - first, c ] = self._read_mapped( file_list[d], samples[d], a, b )[:, c]
+
+                writer[ "queue" ].put( out )
+
+                self._progress( "fill", last, nframes, lambda: "C:{0:08d} F:{1:s} ({2:5.1f}%)".format(
+                    chunk_num, self.sample_to_time( last ), 100.0 * last / nframes ))
+        finally:
+            # close file, also when something fails, so the writer thread doesn't wait forever
+            self._finish_writer( writer, wav_out )
+
+        print()
+        self._stage_done( "fill", t0, nframes, ( nframes + int( plan[ "length" ].sum() ) ) * nchannels * sampwidth )
+    # END DAT_Fix.do_scan_and_fill()
+
+    def make_patch( self, file_list, thresh=100 ):
+        """
+        " the fill of do_scan_and_fill() as an edit list, rather than a new copy of the tape
+        "
+        " inputs:
+        "   file_list: list of file info dicts, after analyze() and align_takes()
+        "              the first is the master, followed by one or more donors
+        "   thresh:    optional - specify threshold dropout size to fill
+        "
+        " outputs:
+        "   patch{} - see save_patch() and apply_patch()
+        "   patch[ "takes" ]   - name and identity of each take, see _sidecar_key()
+        "   patch[ "start" ]   - frame of the master that is the first frame of the output
+        "   patch[ "nframes" ] - frames in the output
+        "   patch[ "edits" ]   - PATCH_DTYPE array in frame order. A region of plan_fill() is
+        "                        split where the donor's offset map changes, so each edit has one offset
+        """
+        master  = file_list[0]
+        plan    = self.plan_fill( file_list, thresh )
+        nframes = min( self._program_length( file ) for file in file_list )
+
+        edits = []
+        for region in plan:
+            d = int( region[ "donor" ] )
+            # only the frames of the output are edited
+            first = max( region[ "start" ], 0 )
+            last  = min( region[ "start" ] + region[ "length" ], nframes )
+            if d == 0 or first >= last:
+                continue
+            breaks = self._offset_map( file_list[d] )
+            lead   = file_list[d][ "leader_length" ]
+
+            i = max( np.searchsorted( breaks[:, 0], first, side="right" ) - 1, 0 )
+            j = max( np.searchsorted( breaks[:, 0], last - 1, side="right" ) - 1, 0 )
+            for k in range( i, j + 1 ):
+                seg_first = max( first, breaks[k, 0] ) if k > i else first
+                seg_last  = min( last, breaks[k + 1, 0] ) if k < j else last
+                edits.append( ( region[ "channel" ], seg_first, seg_last - seg_first, d, lead + breaks[k, 1] ) )
+
+        takes = []
+        for file in file_list:
+            key = self._sidecar_key( file )
+            takes.append( { "name":file[ "name" ], "size":key[ "size" ], "hash":key[ "hash" ] } )
+
+        return { "version":PATCH_VERSION, "thresh":thresh, "takes":takes,
+                 "nchannels":master[ "nchannels" ], "sampwidth":master[ "sampwidth" ],
+                 "framerate":master[ "framerate" ], "start":self._program_start( master ),
+                 "nframes":nframes,
+                 "edits":np.sort( np.array( edits, dtype=PATCH_DTYPE ), order=[ "start", "channel" ] ) }
+    # END DAT_Fix.make_patch()
+
+    def save_patch( self, patch, fname ):
+        """
+        " save a patch from make_patch() as JSON, the edits as
+        " [ channel, start, length, take, offset ] lists
+        "
+        " the take names are saved relative to the patch file, so the
+        " patch can be archived in the same directory as the takes
+        """
+        record = dict( patch )
+        record[ "takes" ] = [ dict( take, name=os.path.relpath( take[ "name" ], os.path.dirname( os.path.abspath( fname ) ) ) )
+                              for take in patch[ "takes" ] ]
+        record[ "fields" ] = list( PATCH_DTYPE.names )
+        record[ "edits" ]  = [ [ int( x ) for x in edit ] for edit in patch[ "edits" ] ]
+
+        with open( fname, "w" ) as f:
+            json.dump( record, f )
+            f.write( "\n" )
+    # END DAT_Fix.save_patch()
+
+    def load_patch( self, fname ):
+        """
+        " read a patch saved by save_patch()
+        """
+        with open( fname ) as f:
+            record = json.load( f )
+
+        if record.get( "version" ) != PATCH_VERSION:
+            print( "{0:s} is not a patch this version can apply".format( fname ) )
+            raise ValueError
+
+        record[ "takes" ] = [ dict( take, name=os.path.join( os.path.dirname( fname ), take[ "name" ] ) )
+                              for take in record[ "takes" ] ]
+        record[ "edits" ] = np.array( [ tuple( edit ) for edit in record.pop( "edits" ) ], dtype=PATCH_DTYPE )
+        del record[ "fields" ]
+        return record
+    # END DAT_Fix.load_patch()
+
+    def apply_patch( self, patch, out_name="out.wav", in_place=False ):
+        """
+        " build the repaired tape from a patch
+        "
+        " the frames of the master that aren't edited are copied in bulk, file to file, with
+        " os.copy_file_range() or os.sendfile() where the system has them, so the data doesn't
+        " pass through Python. Only the edited spans are read from the takes and written
+        "
+        " inputs:
+        "   patch    - patch{} from make_patch(), or the name of a file saved by save_patch()
+        "   out_name - optional - file to write
+        "   in_place - optional - out_name is a working copy of the whole master, with only the
+        "              edited samples overwritten, see _patch_in_place()
+        "
+        " outputs:
+        "   out_name: merged file, the same as do_scan_and_fill() writes
+        """
+        t0 = self._stage_start()
+        if isinstance( patch, str ):
+            patch = self.load_patch( patch )
+
+        # the takes must be the ones the patch was made from
+        file_list = []
+        for take in patch[ "takes" ]:
+            file = { "name":take[ "name" ] }
+            self.get_file_info( file )
+            key = self._sidecar_key( file )
+            if key[ "size" ] != take[ "size" ] or key[ "hash" ] != take[ "hash" ]:
+                print( "{0:s} has changed since the patch was made".format( take[ "name" ] ) )
+                raise ValueError
+            file_list.append( file )
+
+        edits = patch[ "edits" ]
+        ends  = edits[ "start" ] + edits[ "length" ]
+        if np.any( ( edits[ "start" ] < 0 ) | ( ends > patch[ "nframes" ] ) | ( edits[ "length" ] <= 0 ) |
+                   ( edits[ "take" ] >= len( file_list ) ) | ( edits[ "channel" ] >= patch[ "nchannels" ] ) ):
+            print( "patch has edits outside its {0:d} frames".format( patch[ "nframes" ] ) )
+            raise ValueError
+
+        if in_place:
+            self._patch_in_place( patch, file_list, out_name )
+            self._stage_done( "patch", t0, 0, 2 * int( patch[ "edits" ][ "length" ].sum() ) * file_list[0][ "sampwidth" ] )
+            return
+
+        master    = file_list[0]
+        nchannels = patch[ "nchannels" ]
+        sampwidth = patch[ "sampwidth" ]
+        nframes   = patch[ "nframes" ]
+        start     = patch[ "start" ]
+        framebytes = nchannels * sampwidth
+        self.framerate = patch[ "framerate" ]
+
+        samples = [ self._map_samples( file ) for file in file_list ]
+
+        # edits of different channels over the same frames are written together
+        spans = []
+        for edit in edits:
+            (first, last) = ( edit[ "start" ], edit[ "start" ] + edit[ "length" ] )
+            if spans and first <= spans[-1][1]:
+                spans[-1][1] = max( spans[-1][1], last )
+            else:
+                spans.append( [ first, last ] )
+
+        with open( master[ "name" ], "rb" ) as src, open( out_name, "wb", buffering=0 ) as dst:
+            dst.write( self._wave_header( nchannels, sampwidth, patch[ "framerate" ], nframes ) )
+
+            frame = 0
+            next = 0 # next edit to apply
+            for (first, last) in spans + [ [ nframes, nframes ] ]:
+                # unchanged frames straight from the master
+                self._copy_range( src.fileno(), dst.fileno(),
+                                  master[ "data_offset" ] + ( start + frame ) * framebytes, ( first - frame ) * framebytes )
+                if first == nframes:
+                    break
+
+                out = np.array( self._slice_frames( samples[0], start + first, start + last ) )
+                while next < len( edits ) and edits[ "start" ][ next ] < last:
+                    edit = edits[ next ]
+                    a = edit[ "start" ]
+                    b = a + edit[ "length" ]
+                    out[ a - first : b - first, edit[ "channel" ] ] = self._slice_frames(
+                        samples[ edit[ "take" ] ], a + edit[ "offset" ], b + edit[ "offset" ] )[:, edit[ "channel" ] ]
+                    next += 1
+
+                data = memoryview( out.astype( "<i2" ).tobytes() )
+                while data:
+                    data = data[ dst.write( data ): ]
+                frame = last
+
+                self._progress( "patch", last, nframes, lambda: "F:{0:s} ({1:5.1f}%)".format(
+                    self.sample_to_time( last ), 100.0 * last / nframes ))
+
+        if not self.quiet:
+            print()
+        self._stage_done( "patch", t0, nframes, ( nframes + int( edits[ "length" ].sum() ) ) * framebytes )
+    # END DAT_Fix.apply_patch()
+
+    def repair_in_place( self, file_list, thresh=100, out_name=None ):
+        """
+        " fill the dropouts of the master in a working copy of it, rather than writing a new file
+        "
+        " the copy is a clone sharing the master's blocks on filesystems that support it,
+        " and only the dropout samples are written, so the time and disk space this takes
+        " depend on the dropouts rather than the length of the tape. The regions filled and
+        " their donors come from plan_fill(), as for do_scan_and_fill(). This differs from
+        " do_scan_and_fill_2() even for two takes: a region where the donor is no better than
+        " the master is left alone rather than copied from the donor
+        "
+        " inputs:
+        "    file_list: list of file info dicts, after analyze() and align_takes()
+        "               the first is the master, followed by one or more donors
+        "    thresh:    optional - specify threshold dropout size to fill
+        "    out_name:  optional - working copy, <master>.repaired.wav by default
+        "
+        " outputs:
+        "    out_name:  the master, with its header, leader and trailer, and the dropouts filled
+        """
+        if len( file_list ) < 2:
+            print( "Need at least two takes to fill from" )
+            raise ValueError
+        if out_name is None:
+            out_name = os.path.splitext( file_list[0][ "name" ] )[0] + ".repaired.wav"
+
+        self.apply_patch( self.make_patch( file_list, thresh ), out_name, in_place=True )
+    # END DAT_Fix.repair_in_place()
+
+    def _patch_in_place( self, patch, file_list, out_name ):
+        """
+        " internal function used by DAT_Fix.apply_patch()
+        "
+        " copy the master to out_name and write the edits into the copy through a writable memory
+        " map of its data chunk, then flush it to disk. Nothing else in the copy is touched, and
+        " the parts of edits outside the donor or the copy are skipped
+        """
+        master = file_list[0]
+        if os.path.exists( out_name ) and os.path.samefile( out_name, master[ "name" ] ):
+            print( "won't overwrite the master {0:s}, repair a copy of it".format( out_name ) )
+            raise ValueError
+
+        how = self._clone_file( master[ "name" ], out_name )
+        print( "{0:s} {1:s} to {2:s}".format( "cloned" if how == "clone" else "copied", master[ "name" ], out_name ) )
+
+        out = dict( master, name=out_name )
+        target  = self._map_samples( out, mode="r+" )
+        samples = [ self._map_samples( file ) for file in file_list ]
+        start   = patch[ "start" ]
+
+        regions = 0
+        filled  = 0
+        for edit in patch[ "edits" ]:
+            # only the frames both the donor and the copy have, zeros would silently replace the master
+            donor  = samples[ edit[ "take" ] ]
+            offset = edit[ "offset" ]
+            c = edit[ "channel" ]
+            a = max( edit[ "start" ], -offset, -start )
+            b = min( edit[ "start" ] + edit[ "length" ], len( donor ) - offset, len( target ) - start )
+            if a >= b:
+                continue
+            target[ start + a : start + b, c ] = donor[ a + offset : b + offset, c ]
+            regions += 1
+            filled  += b - a
+
+        if isinstance( target, np.memmap ):
+            target.flush()
+        del target
+        with open( out_name, "rb+" ) as f:
+            os.fsync( f.fileno() )
+
+        print( "filled {0:d} regions, {1:d} samples".format( regions, filled ) )
+        if filled < int( patch[ "edits" ][ "length" ].sum() ):
+            print( "  skipped {0:d} samples the donors don't have".format( int( patch[ "edits" ][ "length" ].sum() ) - filled ) )
+    # END DAT_Fix._patch_in_place()
+
+    def _clone_file( self, src, dst ):
+        """
+        " internal function used by DAT_Fix._patch_in_place()
+        "
+        " copy src to dst as a reflink (FICLONE) where the filesystem supports it, so the copy
+        " shares the blocks of src until they are written, otherwise copy it in the kernel
+        "
+        " outputs:
+        "   "clone" or "copy"
+        """
+        with open( src, "rb" ) as f_src, open( dst, "wb" ) as f_dst:
+            if fcntl is not None:
+                try:
+                    fcntl.ioctl( f_dst.fileno(), FICLONE, f_src.fileno() )
+                    return "clone"
+                except OSError:
+                    pass
+            self._copy_range( f_src.fileno(), f_dst.fileno(), 0, os.fstat( f_src.fileno() ).st_size )
+        return "copy"
+    # END DAT_Fix._clone_file()
+
+    def find_sessions( self, root, manifest=None ):
+        """
+        " find the sessions, the sets of takes of one tape, to process in a batch
+        "
+        " every directory under root holding wave files is a session. Where a directory
+        " holds the takes of several tapes, named <tape>_take1.wav, <tape>_2.wav, ..., see
+        " TAKE_PATTERN, each tape is a session of its own. Takes are in order of their
+        " number, so the first one is the master. Files written by the tools are left out
+        "
+        " inputs:
+        "   root     - directory to search
+        "   manifest - optional - JSON file listing the sessions instead,
+        "              { "sessions": [ { "name": "tape001", "takes": [ "a.wav", "b.wav" ] }, ... ] }
+        "              with the takes relative to the manifest
+        "
+        " outputs:
+        "   list of { "name", "takes", "output" } dicts, in order of name, see _name_outputs()
+        """
+        if manifest is not None:
+            with open( manifest ) as f:
+                listed = json.load( f )[ "sessions" ]
+            return self._name_outputs( [ { "name":session[ "name" ],
+                                           "takes":[ os.path.join( os.path.dirname( manifest ), take ) for take in session[ "takes" ] ] }
+                                         for session in listed ] )
+
+        def take_number( name ):
+            match = TAKE_PATTERN.match( os.path.splitext( name )[0] )
+            return ( match.group( 1 ), int( match.group( 2 ) ) ) if match else ( os.path.splitext( name )[0], 0 )
+
+        sessions = []
+        for (directory, dirs, names) in os.walk( root ):
+            dirs.sort()
+            takes = [ name for name in names if name.lower().endswith( ".wav" )
+                      and not name.lower().endswith( ( BATCH_OUTPUT, ".repaired.wav" ) ) and name != "out.wav" ]
+            if not takes:
+                continue
+
+            tapes = {}
+            for name in sorted( takes ):
+                (tape, number) = take_number( name )
+                tapes.setdefault( tape, [] ).append( ( number, name ) )
+
+            where = os.path.relpath( directory, root )
+            for (tape, numbered) in sorted( tapes.items() ):
+                # takes named just take1.wav, take2.wav, ... are a tape named after their directory
+                tape = tape or os.path.basename( os.path.abspath( directory ) )
+                if len( tapes ) == 1 and where != ".":
+                    name = where
+                else:
+                    name = tape if where == "." else os.path.join( where, tape )
+                sessions.append( { "name":name, "takes":[ os.path.join( directory, take ) for (n, take) in sorted( numbered ) ] } )
+
+        return self._name_outputs( sorted( sessions, key=lambda session: session[ "name" ] ) )
+    # END DAT_Fix.find_sessions()
+
+    def _name_outputs( self, sessions ):
+        """
+        " internal function used by DAT_Fix.find_sessions()
+        "
+        " name the files of each session in the output directory: the session name with
+        " the directory separators made underscores, and -2, -3, ... added where that makes
+        " it the same as an earlier session's, so "a/b" and "a_b" don't share files. The
+        " names depend only on the sessions, so a batch run again finds the same files
+        """
+        used = set()
+        for session in sessions:
+            base = session[ "name" ].replace( os.sep, "_" ).replace( "/", "_" ) or "session"
+            output = base
+            n = 2
+            while output.lower() in used: # the same on case insensitive filesystems too
+                output = "{0:s}-{1:d}".format( base, n )
+                n += 1
+            used.add( output.lower() )
+            session[ "output" ] = output
+        return sessions
+    # END DAT_Fix._name_outputs()
+
+    def _session_base( self, session, out_dir ):
+        """
+        " internal function used by DAT_Fix.run_session() and _session_worker()
+        " the path of a session's files in out_dir, less the BATCH_OUTPUT, ... suffix
+        """
+        return os.path.join( out_dir, session.get( "output" ) or session[ "name" ].replace( os.sep, "_" ) )
+    # END DAT_Fix._session_base()
+
+    def run_batch( self, sessions, out_dir, thresh=20, jobs=1, differences=False ):
+        """
+        " process sessions from find_sessions(), up to jobs of them at the same time
+        " in separate worker processes, see run_session()
+        "
+        " an interrupted batch run again with the same out_dir carries on where it stopped,
+        " finished sessions are skipped and unfinished ones resume from their journal
+        "
+        " outputs:
+        "   dict of session name to its status, also printed as each session finishes
+        """
+        os.makedirs( out_dir, exist_ok=True )
+        status = {}
+
+        if jobs <= 1 or len( sessions ) < 2:
+            for session in sessions:
+                (result, seconds) = _session_worker( session, out_dir, thresh, differences, self.use_cache )
+                status[ session[ "name" ] ] = result
+                print( "session: {0:s} {1:s} ({2:.1f}s)".format( session[ "name" ], result, seconds ))
+            return status
+
+        with ProcessPoolExecutor( max_workers=min( jobs, len( sessions ) ) ) as pool:
+            futures = { pool.submit( _session_worker, session, out_dir, thresh, differences, self.use_cache ): session
+                        for session in sessions }
+            for future in as_completed( futures ):
+                (result, seconds) = future.result()
+                status[ futures[ future ][ "name" ] ] = result
+                print( "session: {0:s} {1:s} ({2:.1f}s) {3:d}/{4:d}".format(
+                    futures[ future ][ "name" ], result, seconds, len( status ), len( sessions ) ))
+        return status
+    # END DAT_Fix.run_batch()
+
+    def run_session( self, session, out_dir, thresh=20, differences=False ):
+        """
+        " analyze, align and fill the takes of one session, writing <output>.fixed.wav and
+        " <output>.report.txt to out_dir, see BATCH_OUTPUT, BATCH_REPORT and _name_outputs()
+        "
+        " each stage finished is recorded in <output>.journal.jsonl, with the name, size and
+        " hash of each take (see _sidecar_key()), and only reused while they are the same, so when a session is run
+        " again the stages already done are skipped: a filled session isn't touched, the
+        " alignment is read back from the journal, and the analysis comes from the sidecars
+        "
+        " inputs:
+        "   session     - { "name", "takes", "output" } dict from find_sessions(), the first take is the master
+        "   out_dir     - directory for the outputs
+        "   thresh      - optional - dropout threshold
+        "   differences - optional - also fill where a take differs from the others, see scan_differences()
+        "
+        " outputs:
+        "   "done", or "skipped" if the journal says it was already done
+        """
+        base = self._session_base( session, out_dir )
+        journal_name = base + BATCH_JOURNAL
+
+        # the stages in the journal only count for the same takes, unchanged since
+        file_list = [ { "name":name } for name in session[ "takes" ] ]
+        for file in file_list:
+            self.get_file_info( file )
+        identity = []
+        for file in file_list:
+            key = self._sidecar_key( file )
+            identity.append( { "name":file[ "name" ], "size":key[ "size" ], "hash":key[ "hash" ] } )
+        stages = { stage:record for (stage, record) in self._read_journal( journal_name ).items()
+                   if record.get( "identity" ) == identity }
+
+        if stages.get( "fill", {} ).get( "thresh" ) == thresh or (
+                len( session[ "takes" ] ) < 2 and stages.get( "analyze", {} ).get( "thresh" ) == thresh ):
+            return "skipped"
+
+        with open( journal_name, "a" ) as journal, open( base + BATCH_REPORT, "a" ) as report, \
+             contextlib.redirect_stdout( report ):
+            print( "session: {0:s} {1:s}".format( session[ "name" ], time.strftime( "%Y-%m-%d %H:%M:%S" ) ))
+
+            for file in file_list:
+                self.analyze( file, thresh )
+            self._journal( journal, "analyze", identity=identity, thresh=thresh, takes=[
+                { "name":file[ "name" ], "leader_length":file[ "leader_length" ], "trailer_length":file[ "trailer_length" ],
+                  "dropout_score":list( file[ "dropout_score" ] ), "dropouts":len( file[ "dropouts" ] ) } for file in file_list ] )
+            if len( file_list ) < 2:
+                return "done"
+
+            if "align" in stages:
+                for (file, aligned) in zip( file_list, stages[ "align" ][ "takes" ] ):
+                    file[ "offset" ]      = aligned[ "offset" ]
+                    file[ "align_match" ] = aligned[ "align_match" ]
+                    file[ "offset_map" ]  = np.array( aligned[ "offset_map" ], dtype=np.int64 ).reshape( -1, 2 )
+            else:
+                self.align_takes( file_list )
+                self.map_drift( file_list )
+                self._journal( journal, "align", identity=identity, takes=[
+                    { "offset":int( file[ "offset" ] ), "align_match":float( file[ "align_match" ] ),
+                      "offset_map":file[ "offset_map" ].tolist() } for file in file_list ] )
+
+            if differences and len( file_list ) > 2:
+                self.scan_differences( file_list )
+
+            # written under a temporary name, so an interrupted fill is never taken for a finished one
+            self.do_scan_and_fill( file_list, thresh=thresh, out_name=base + BATCH_OUTPUT + ".tmp" )
+            os.replace( base + BATCH_OUTPUT + ".tmp", base + BATCH_OUTPUT )
+            self._journal( journal, "fill", identity=identity, thresh=thresh, output=base + BATCH_OUTPUT )
+        return "done"
+    # END DAT_Fix.run_session()
+
+    def _read_journal( self, name ):
+        """
+        " internal function used by DAT_Fix.run_session()
+        " the last record of each stage in a journal, a line cut short by a crash is ignored
+        """
+        stages = {}
+        if not os.path.exists( name ):
+            return stages
+        with open( name ) as f:
+            for line in f:
+                try:
+                    record = json.loads( line )
+                except ValueError:
+                    continue
+                stages[ record[ "stage" ] ] = record
+        return stages
+    # END DAT_Fix._read_journal()
+
+    def _journal( self, journal, stage, **record ):
+        """
+        " internal function used by DAT_Fix.run_session()
+        " add a finished stage to the journal, on disk before going on to the next stage
+        """
+        journal.write( json.dumps( dict( stage=stage, time=time.time(), **record ) ) + "\n" )
+        journal.flush()
+        os.fsync( journal.fileno() )
+    # END DAT_Fix._journal()
+
+    def _wave_header( self, nchannels, sampwidth, framerate, nframes ):
+        """
+        " internal function used by DAT_Fix.apply_patch()
+        " the 44 byte header of a PCM wave file, the same as the wave module writes
+        """
+        data_len = nframes * nchannels * sampwidth
+        return struct.pack( "<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_len, b"WAVE", b"fmt ", 16, 1,
+                            nchannels, framerate, framerate * nchannels * sampwidth, nchannels * sampwidth,
+                            sampwidth * 8, b"data", data_len )
+    # END DAT_Fix._wave_header()
+
+    def _copy_range( self, src, dst, offset, count ):
+        """
+        " internal function used by DAT_Fix.apply_patch()
+        "
+        " copy count bytes from offset in file descriptor src to the current position of dst,
+        " within the kernel where possible: copy_file_range() (which can share the blocks on
+        " filesystems that support it), then sendfile(), then reading and writing
+        """
+        for method in ( "copy_file_range", "sendfile", None ):
+            if count <= 0:
+                return
+            try:
+                while count > 0:
+                    if method == "copy_file_range":
+                        n = os.copy_file_range( src, dst, count, offset )
+                    elif method == "sendfile":
+                        n = os.sendfile( dst, src, offset, count )
+                    else:
+                        data = os.pread( src, min( count, 1 << 24 ), offset )
+                        n = os.write( dst, data )
+                    if n == 0: # end of the source file
+                        return
+                    offset += n
+                    count  -= n
+            except ( AttributeError, OSError ):
+                if method is None:
+                    raise
+    # END DAT_Fix._copy_range()
+
+
+def _analyze_worker( fname, thresh, use_cache ):
+    """
+    " worker process for DAT_Fix.analyze_takes()
+    "
+    " returns the file info dict, the printed output, keeping only the
+    " last state of each progress line, and the stage timings
+    """
+    df = DAT_Fix()
+    df.use_cache = use_cache
+    df.quiet = True
+    file = { "name":fname }
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout( out ):
+        df.get_file_info( file )
+        df.analyze( file, thresh )
+
+    log = "".join( line.split( '\r' )[-1] for line in out.getvalue().splitlines( True ) )
+    return ( file, log, df.metrics )
+# END _analyze_worker()
+
+
+def _scan_segment_worker( file, first, last, run_min, origin ):
+    """
+    " worker process for DAT_Fix._analyze_pass(), see DAT_Fix._scan_segment()
+    """
+    df = DAT_Fix()
+    df.framerate = file[ "framerate" ]
+    return df._scan_segment( file, first, last, run_min, origin )
+# END _scan_segment_worker()
+
+
+def _session_worker( session, out_dir, thresh, differences, use_cache ):
+    """
+    " worker process for DAT_Fix.run_batch(), see DAT_Fix.run_session()
+    "
+    " returns the status of the session and the time it took, a session that fails
+    " doesn't stop the batch, the traceback is added to its report
+    """
+    t0 = time.perf_counter()
+    df = DAT_Fix()
+    df.use_cache = use_cache
+    df.quiet = True
+    try:
+        result = df.run_session( session, out_dir, thresh, differences )
+    except Exception as e:
+        result = "failed: " + ( str( e ) or type( e ).__name__ )
+        try:
+            with open( df._session_base( session, out_dir ) + BATCH_REPORT, "a" ) as report:
+                report.write( traceback.format_exc() )
+        except OSError:
+            pass
+    return ( result, time.perf_counter() - t0 )
+# END _session_worker()
+
+
+def main():
+    parser = argparse.ArgumentParser( description="scan and repair dropouts in wav files from DAT transfers" )
+    parser.add_argument( "files", nargs="*", help="takes of the same tape, the first is the master" )
+    parser.add_argument( "-t", "--thresh", type=int, default=20,
+                         help="runs of more than thresh equal samples are dropouts (default: 20)" )
+    parser.add_argument( "-e", "--export", choices=( "jsonl", "csv" ),
+                         help="save the dropouts of each take to <take>.dropouts.jsonl or .csv" )
+    parser.add_argument( "-j", "--jobs", type=int, default=1,
+                         help="number of worker processes, for analyzing several takes at the same time "
+                              "or segments of a single take (default: 1, 0: one per core)" )
+    parser.add_argument( "-d", "--differences", action="store_true",
+                         help="with three or more takes, also fill where a take differs from the others, "
+                              "to catch noisy dropouts" )
+    parser.add_argument( "-w", "--timeline", type=float, metavar="SECONDS",
+                         help="score the takes every SECONDS and print where each one is best" )
+    parser.add_argument( "-p", "--patch", metavar="FILE",
+                         help="save the fill as an edit list in FILE rather than writing out.wav" )
+    parser.add_argument( "--apply", metavar="FILE",
+                         help="write out.wav from an edit list saved with --patch, no takes are given" )
+    parser.add_argument( "--in-place", metavar="FILE",
+                         help="fill the dropouts in FILE, a copy of the master, rather than writing out.wav" )
+    parser.add_argument( "--batch", metavar="DIR",
+                         help="process every session (the takes of one tape) found under DIR, no takes are given" )
+    parser.add_argument( "--manifest", metavar="FILE", help="with --batch, the sessions listed in FILE" )
+    parser.add_argument( "-o", "--out-dir", metavar="DIR",
+                         help="with --batch, where the outputs, reports and journals go (default: the --batch DIR)" )
+    parser.add_argument( "-q", "--quiet", action="store_true", help="don't print progress lines" )
+    parser.add_argument( "--metrics", action="store_true", help="print the time taken by each stage at the end" )
+    parser.add_argument( "--profile", metavar="FILE", help="save a cProfile capture of the run to FILE" )
+    args = parser.parse_args()
+    if not args.files and not args.apply and not args.batch:
+        parser.error( "no takes given" )
+
     df=DAT_Fix()
+    df.quiet = args.quiet
+
+    if args.profile:
+        profile = cProfile.Profile()
+        profile.enable()
+
+    if args.batch:
+        df.jobs = 1
+        sessions = df.find_sessions( args.batch, args.manifest )
+        df.run_batch( sessions, args.out_dir or args.batch, args.thresh,
+                      jobs=args.jobs if args.jobs > 0 else os.cpu_count(), differences=args.differences )
+
+    if args.apply and args.in_place:
+        df.apply_patch( args.apply, args.in_place, in_place=True )
+    elif args.apply:
+        df.apply_patch( args.apply )
 
     # process argument list as filenames
     file_list=[]
-    for fname in sys.argv[1:]:
+    for fname in args.files:
         datfile={ "name":fname }
         file_list.append(datfile)
 
-    # get information on all files
-    for i in range( len(file_list) ):
-        df.get_file_info( file_list[i] )
-        #df.print_file_info( file_list[i] )
-        df.get_leader_length( file_list[i] )
-        df.dropout_score( file_list[i] )
+    thresh = args.thresh
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    # get information on all files, in a single pass through each one
+    df.jobs = jobs
+    df.analyze_takes( file_list, thresh, jobs=jobs )
+    if args.export:
+        for file in file_list:
+            df.export_events( df.dropout_events( file, thresh ), file[ "name" ] + ".dropouts." + args.export, file[ "framerate" ] )
+    #for i in range( len(file_list) ):
+    #    df.print_file_info( file_list[i] )
+    #    df.print_dropouts( file_list[i] )
+
+    # line the takes up with each other
+    if len( file_list ) > 1:
+        df.align_takes( file_list )
+        df.map_drift( file_list )
+    if len( file_list ) > 2 and args.differences:
+        df.scan_differences( file_list )
+    if file_list and args.timeline:
+        df.quality_timeline( file_list, args.timeline )
+        df.print_best_takes( file_list )
         
     #for i in range( len(file_list) ):
     #    print("L: {0:s}\tlead frames: {1:d}".format(
     #        file_list[i][ "name" ], file_list[i][ "leader_length"] ))
         
     #df.median_3( file_list )
-    df.do_scan_and_fill_2( file_list, thresh=20 )
+    #df.do_scan_and_fill_2( file_list, thresh=thresh )
+    if len( file_list ) > 1 and args.patch:
+        df.save_patch( df.make_patch( file_list, thresh=thresh ), args.patch )
+    elif len( file_list ) > 1 and args.in_place:
+        df.repair_in_place( file_list, thresh=thresh, out_name=args.in_place )
+    elif len( file_list ) > 1:
+        df.do_scan_and_fill( file_list, thresh=thresh )
 
     # analyze the generated file for possible improvement
     #print("analyzing outfile")
     #outfile={ "name":"out.wav" }
     #df.get_file_info( outfile )
     #df.dropout_score( outfile )
+
+    if args.profile:
+        profile.disable()
+        profile.dump_stats( args.profile )
+    if args.metrics:
+        df.print_metrics()
+# END main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+#!/usr/bin/python
+
+# benchmark dat_fix.py on synthetic DAT takes with known dropouts
+#
+# a program is generated once, and each take is a copy of it with its own leader,
+# trailer, start offset and injected dropouts: held value dropouts, which the tools
+# detect as runs of duplicated samples, and noisy ones, which only other takes can fix.
+# Every operation is timed in a fresh worker process, for each CHUNK size and take length,
+# and its output is hashed so that runs before and after a change can be compared
+#
+#   python dat_fix_bench.py --seconds 60 600 --chunks 1024 4096 16384 --json before.json
+#   python dat_fix_bench.py --seconds 60 600 --chunks 1024 4096 16384 --compare before.json
+
+import wave
+import numpy as np
+import os
+import sys
+import time
+import json
+import hashlib
+import argparse
+import tempfile
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+
+import dat_fix
+
+FRAMERATE=48000
+
+# frames of the program generated at once
+GEN_BLOCK=1<<20
+
+# injected dropouts: channel, first replaced frame and number of frames, all in file frames
+TRUTH_DTYPE = np.dtype( [ ("channel", np.uint8), ("start", np.int64), ("length", np.int64), ("noisy", np.bool_) ] )
+
+OPERATIONS = ( "info", "leader", "trailer", "score_mem", "score_chunk", "analyze", "scan",
+               "align", "drift", "fill", "fill_2", "median", "patch", "in_place", "diff", "timeline" )
+
+# operations that write the same file as fill, their digests must match it
+SAME_AS_FILL = ( "patch", "in_place" )
+
+
+def make_program( nframes, seed ):
+    """
+    " stereo 16 bit program: tones with a slowly changing level and some noise,
+    " with quiet passages where real duplicated samples occur, as on a real tape
+    """
+    rng = np.random.default_rng( seed )
+    program = np.empty( ( nframes, 2 ), dtype=np.int16 )
+
+    for first in range( 0, nframes, GEN_BLOCK ):
+        t = np.arange( first, min( nframes, first + GEN_BLOCK ) )
+        level = 4000 * ( 1.1 + np.sin( t / ( 7.3 * FRAMERATE ) ) )
+        for (c, period) in enumerate( ( 37.0, 53.0 ) ):
+            x = level * np.sin( t / period ) + 0.3 * level * np.sin( t / ( 3.1 * period ) )
+            x += rng.normal( 0, 1, len( t ) ) * level / 20
+            program[ first : first + len( t ), c ] = np.clip( x, -32768, 32767 )
+    return program
+# END make_program()
+
+def make_take( name, program, lead, skip, trail, drops, drop_min, drop_max, noisy, seed ):
+    """
+    " write one take of the program and return its injected dropouts
+    "
+    " inputs:
+    "   lead, trail - frames of digital silence before and after the program
+    "   skip        - frames missing from the start of the program, so takes are offset
+    "   drops       - number of dropouts to inject, of drop_min to drop_max frames,
+    "                 the fraction noisy of them noisy rather than held
+    """
+    rng = np.random.default_rng( seed )
+    take = np.concatenate( ( np.zeros( ( lead, 2 ), dtype=np.int16 ), program[ skip: ],
+                             np.zeros( ( trail, 2 ), dtype=np.int16 ) ) )
+
+    truth = np.zeros( drops, dtype=TRUTH_DTYPE )
+    truth[ "channel" ] = rng.integers( 0, 2, drops )
+    truth[ "length" ]  = rng.integers( drop_min, drop_max + 1, drops )
+    truth[ "start" ]   = lead + 1 + rng.integers( 0, max( 1, len( program ) - skip - 1 - drop_max ), drops )
+    truth[ "noisy" ]   = rng.random( drops ) < noisy
+    truth = truth[ np.argsort( truth[ "start" ] ) ]
+
+    for d in truth:
+        (c, s, n) = ( d[ "channel" ], d[ "start" ], d[ "length" ] )
+        if d[ "noisy" ]:
+            take[ s : s + n, c ] = rng.integers( -32768, 32768, n )
+        else:
+            take[ s : s + n, c ] = take[ s - 1, c ]
+
+    wav = wave.open( name, "wb" )
+    wav.setnchannels( 2 )
+    wav.setsampwidth( 2 )
+    wav.setframerate( FRAMERATE )
+    for first in range( 0, len( take ), GEN_BLOCK ):
+        wav.writeframesraw( take[ first : first + GEN_BLOCK ].astype( "<i2" ).tobytes() )
+    wav.close()
+    return truth
+# END make_take()
+
+def make_session( directory, seconds, takes, density, drop_min, drop_max, noisy, seed=1 ):
+    """
+    " generate takes of a program seconds long, density dropouts per minute in each
+    "
+    " outputs:
+    "   list of (name, truth) for each take, the first is the master
+    """
+    program = make_program( int( seconds * FRAMERATE ), seed )
+    drops = int( density * seconds / 60 )
+
+    session = []
+    for i in range( takes ):
+        name = os.path.join( directory, "take{0:d}.wav".format( i + 1 ) )
+        truth = make_take( name, program, lead=FRAMERATE + 1000 * i, skip=7 * i, trail=FRAMERATE // 2 + 500 * i,
+                           drops=drops, drop_min=drop_min, drop_max=drop_max, noisy=noisy, seed=seed + 100 + i )
+        session.append( ( name, truth ) )
+    return session
+# END make_session()
+
+def score_events( events, truth, lead, end, thresh ):
+    """
+    " detection recall and precision of scan_file() events against the injected dropouts
+    "
+    " an event is a true detection if its run overlaps an injected dropout in the same
+    " channel. Held dropouts long enough to exceed thresh should all be found, noisy
+    " ones aren't runs of duplicates and aren't counted against recall
+    """
+    # only the program, the leader and trailer are runs of zeros too
+    events = events[ ( events[ "start" ] > lead ) & ( events[ "start" ] < end ) ]
+
+    found = np.zeros( len( truth ), dtype=bool )
+    true_events = 0
+    for c in range( 2 ):
+        t = truth[ truth[ "channel" ] == c ]
+        t_idx = np.flatnonzero( truth[ "channel" ] == c )
+        t_end = t[ "start" ] + t[ "length" ]
+        for e in events[ events[ "channel" ] == c ]:
+            first = e[ "start" ] - 1
+            last  = e[ "start" ] + e[ "length" ]
+            lo = np.searchsorted( t_end, first, side="right" )
+            hi = np.searchsorted( t[ "start" ], last, side="left" )
+            if hi > lo:
+                true_events += 1
+                found[ t_idx[ lo:hi ] ] = True
+
+    detectable = ~truth[ "noisy" ] & ( truth[ "length" ] > thresh )
+    recall    = found[ detectable ].mean() if detectable.any() else 1.0
+    precision = true_events / len( events ) if len( events ) else 1.0
+    return ( float( recall ), float( precision ) )
+# END score_events()
+
+def _digest( *items ):
+    """
+    " hash of arrays, numbers and files (given as "file:" + name) to compare outputs between runs
+    """
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance( item, str ) and item.startswith( "file:" ):
+            with open( item[ 5: ], "rb" ) as f:
+                for block in iter( lambda: f.read( 1 << 20 ), b"" ):
+                    h.update( block )
+        elif isinstance( item, np.ndarray ):
+            h.update( np.ascontiguousarray( item ).tobytes() )
+        else:
+            h.update( repr( item ).encode() )
+    return h.hexdigest()[:16]
+# END _digest()
+
+def _peak_rss_mb():
+    """
+    " peak resident size of this process so far, in MB
+    """
+    if not resource:
+        return float( "nan" )
+    rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0 # kilobytes on Linux
+    if sys.platform == "darwin": # bytes
+        rss /= 1024.0
+    return rss
+# END _peak_rss_mb()
+
+def _run_operation( directory, names, truth, op, chunk, thresh ):
+    """
+    " worker process: set up the takes as the operation needs them, untimed,
+    " then time the operation and hash its output
+    "
+    " the peak resident size can't be reset, so it is taken after the setup too:
+    " peak_rss_mb is setup + operation, op_rss_mb how far the operation raised it
+    """
+    os.chdir( directory )
+    dat_fix.CHUNK = chunk
+    df = dat_fix.DAT_Fix()
+    df.quiet = True
+    df.use_cache = False
+    devnull = open( os.devnull, "w" )
+    sys.stdout = devnull
+
+    file_list = [ { "name":name } for name in names ]
+    master = file_list[0]
+    needs = { "info":0, "leader":1, "trailer":1, "score_mem":2, "score_chunk":2, "analyze":1, "scan":0,
+              "align":3, "drift":4, "fill":5, "fill_2":5, "median":5, "patch":5, "in_place":5, "diff":5,
+              "timeline":5 }[ op ]
+    if needs >= 1:
+        for file in file_list:
+            df.get_file_info( file )
+    if needs >= 2 or op == "align":
+        for file in file_list:
+            df.analyze( file, thresh )
+    if needs >= 4:
+        df.align_takes( file_list )
+    if needs >= 5:
+        df.map_drift( file_list )
+
+    extra = {}
+    setup_rss = _peak_rss_mb()
+    t0 = time.perf_counter()
+    if op == "info":
+        df.get_file_info( master )
+        digest = _digest( master[ "nframes" ], master[ "data_offset" ] )
+    elif op == "leader":
+        df.get_leader_length( master )
+        digest = _digest( master[ "leader_length" ] )
+    elif op == "trailer":
+        df.get_trailer_length( master )
+        digest = _digest( master[ "trailer_length" ] )
+    elif op == "score_mem":
+        digest = _digest( df.dropout_score_mem( master ) )
+    elif op == "score_chunk":
+        digest = _digest( df.dropout_score_chunk( master ) )
+    elif op == "analyze":
+        df.analyze( master, thresh )
+        digest = _digest( master[ "dropout_score" ], np.sort( master[ "runs" ], order=[ "start", "channel" ] ),
+                          *master[ "dup_hist" ] )
+    elif op == "scan":
+        events = df.scan_file( names[0], thresh, quiet=True )
+        digest = _digest( np.sort( events, order=[ "start", "channel" ] ) )
+        info = { "name":names[0] }
+        df.get_file_info( info )
+        df.analyze( info, thresh )
+        ( extra[ "recall" ], extra[ "precision" ] ) = score_events(
+            events, truth, info[ "leader_length" ], info[ "nframes" ] - info[ "trailer_length" ], thresh )
+    elif op == "align":
+        df.align_takes( file_list )
+        digest = _digest( [ file[ "offset" ] for file in file_list ] )
+    elif op == "drift":
+        df.map_drift( file_list )
+        digest = _digest( *[ file[ "offset_map" ] for file in file_list ] )
+    elif op == "fill":
+        df.do_scan_and_fill( file_list, thresh=thresh )
+        digest = _digest( "file:out.wav" )
+    elif op == "fill_2":
+        df.do_scan_and_fill_2( file_list, thresh=thresh )
+        digest = _digest( "file:out.wav" )
+    elif op == "median":
+        df.consensus( file_list )
+        digest = _digest( "file:out.wav" )
+    elif op == "patch":
+        df.save_patch( df.make_patch( file_list, thresh=thresh ), "out.patch.json" )
+        df.apply_patch( "out.patch.json", "out.wav" )
+        digest = _digest( "file:out.wav" )
+    elif op == "in_place":
+        df.repair_in_place( file_list, thresh=thresh, out_name="repaired.wav" )
+    elif op == "diff":
+        df.scan_differences( file_list )
+        digest = _digest( *[ file[ "differences" ] for file in file_list ] )
+    elif op == "timeline":
+        df.quality_timeline( file_list )
+        digest = _digest( *[ file[ "timeline" ] for file in file_list ] )
+    seconds = time.perf_counter() - t0
+
+    if op == "in_place":
+        # untimed: the program of the working copy, with the header fill writes, is fill's output
+        nframes = min( df._program_length( file ) for file in file_list )
+        repaired = dict( master, name="repaired.wav" )
+        with open( "out.wav", "wb" ) as f:
+            f.write( df._wave_header( master[ "nchannels" ], master[ "sampwidth" ], master[ "framerate" ], nframes ) )
+            start = df._program_start( master )
+            f.write( np.ascontiguousarray( df._map_samples( repaired )[ start : start + nframes ] ).astype( "<i2" ).tobytes() )
+        digest = _digest( "file:out.wav" )
+
+    sys.stdout = sys.__stdout__
+    devnull.close()
+
+    rss = _peak_rss_mb()
+
+    info = { "name":names[0] }
+    dat_fix.DAT_Fix().get_file_info( info )
+    return dict( extra, seconds=seconds, frames_per_second=info[ "nframes" ] / max( seconds, 1e-9 ),
+                 peak_rss_mb=rss, setup_rss_mb=setup_rss, op_rss_mb=rss - setup_rss, digest=digest )
+# END _run_operation()
+
+def main():
+    parser = argparse.ArgumentParser( description="benchmark dat_fix.py on synthetic takes" )
+    parser.add_argument( "--seconds", type=float, nargs="+", default=[ 60 ], help="take lengths (default: 60)" )
+    parser.add_argument( "--chunks", type=int, nargs="+", default=[ dat_fix.CHUNK ], help="CHUNK sizes to try" )
+    parser.add_argument( "--takes", type=int, default=3, help="takes per session (default: 3)" )
+    parser.add_argument( "--thresh", type=int, default=20, help="dropout threshold (default: 20)" )
+    parser.add_argument( "--density", type=float, default=30, help="dropouts per minute per take (default: 30)" )
+    parser.add_argument( "--drop-min", type=int, default=25, help="shortest dropout, frames (default: 25)" )
+    parser.add_argument( "--drop-max", type=int, default=400, help="longest dropout, frames (default: 400)" )
+    parser.add_argument( "--noisy", type=float, default=0.2, help="fraction of noisy dropouts (default: 0.2)" )
+    parser.add_argument( "--ops", nargs="+", choices=OPERATIONS, default=list( OPERATIONS ) )
+    parser.add_argument( "--dir", help="keep the generated takes in this directory" )
+    parser.add_argument( "--json", help="save the results to this file" )
+    parser.add_argument( "--compare", help="report outputs that differ from a saved --json file" )
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp( prefix="dat_fix_bench" )
+    os.makedirs( directory, exist_ok=True )
+
+    # each operation gets a fresh process, so its peak memory is its own setup's and its own
+    context = multiprocessing.get_context( "spawn" )
+
+    results = []
+    try:
+        for seconds in args.seconds:
+            print( "generating {0:d} takes of {1:g}s in {2:s}".format( args.takes, seconds, directory ))
+            session = make_session( directory, seconds, args.takes, args.density,
+                                    args.drop_min, args.drop_max, args.noisy )
+            names = [ os.path.basename( name ) for (name, truth) in session ]
+
+            print( "{0:>8s} {1:>6s} {2:12s} {3:>9s} {4:>12s} {5:>9s} {6:>9s} {7:>7s} {8:>9s}  {9:s}".format(
+                "seconds", "chunk", "operation", "time", "frames/s", "rss MB", "+op MB", "recall", "precision", "digest" ))
+            for chunk in args.chunks:
+                for op in args.ops:
+                    with ProcessPoolExecutor( max_workers=1, mp_context=context ) as pool:
+                        r = pool.submit( _run_operation, directory, names, session[0][1], op, chunk, args.thresh ).result()
+                    r.update( seconds_of_audio=seconds, chunk=chunk, operation=op )
+                    results.append( r )
+                    print( "{0:8g} {1:6d} {2:12s} {3:9.3f} {4:12.0f} {5:9.1f} {6:9.1f} {7:>7s} {8:>9s}  {9:s}".format(
+                        seconds, chunk, op, r[ "seconds" ], r[ "frames_per_second" ], r[ "peak_rss_mb" ], r[ "op_rss_mb" ],
+                        "{0:.3f}".format( r[ "recall" ] ) if "recall" in r else "",
+                        "{0:.3f}".format( r[ "precision" ] ) if "precision" in r else "", r[ "digest" ] ))
+    finally:
+        if not args.dir:
+            shutil.rmtree( directory, ignore_errors=True )
+
+    # the output of an operation shouldn't depend on CHUNK
+    for seconds in args.seconds:
+        for op in args.ops:
+            digests = { r[ "digest" ] for r in results if r[ "seconds_of_audio" ] == seconds and r[ "operation" ] == op }
+            if len( digests ) > 1:
+                print( "CHUNK changes the output: {0:g}s {1:s}".format( seconds, op ))
+
+        # the patch and the working copy must come out the same as fill
+        for r in results:
+            if r[ "seconds_of_audio" ] == seconds and r[ "operation" ] in SAME_AS_FILL:
+                fill = [ f for f in results if f[ "seconds_of_audio" ] == seconds and f[ "chunk" ] == r[ "chunk" ]
+                         and f[ "operation" ] == "fill" ]
+                if fill and fill[0][ "digest" ] != r[ "digest" ]:
+                    print( "{0:s} differs from fill: {1:g}s chunk {2:d}".format( r[ "operation" ], seconds, r[ "chunk" ] ))
+
+    if args.json:
+        with open( args.json, "w" ) as f:
+            json.dump( results, f, indent=1 )
+
+    if args.compare:
+        with open( args.compare ) as f:
+            baseline = { ( r[ "seconds_of_audio" ], r[ "chunk" ], r[ "operation" ] ):r for r in json.load( f ) }
+        changed = 0
+        for r in results:
+            b = baseline.get( ( r[ "seconds_of_audio" ], r[ "chunk" ], r[ "operation" ] ) )
+            if b is None:
+                continue
+            if b[ "digest" ] != r[ "digest" ]:
+                changed += 1
+                print( "output changed: {0:g}s chunk {1:d} {2:s}".format( r[ "seconds_of_audio" ], r[ "chunk" ], r[ "operation" ] ))
+            else:
+                print( "{0:g}s chunk {1:d} {2:12s} {3:9.3f}s -> {4:9.3f}s".format(
+                    r[ "seconds_of_audio" ], r[ "chunk" ], r[ "operation" ], b[ "seconds" ], r[ "seconds" ] ))
+        if changed:
+            sys.exit( 1 )
+# END main()
+
+
+if __name__ == "__main__":
+    main()